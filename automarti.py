@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Command line interface of Automarti.
+
+    python automarti.py compose song.mid --seed 1
+    python automarti.py render song.mid song.wav --soundfont soundfonts/organ/Aggorg.sf2
+    python automarti.py build-dataset dataset --examples 100
+    python automarti.py play song.mid --soundfont soundfonts/organ/Aggorg.sf2
+    python automarti.py serve --socket /tmp/automarti.sock --preload soundfonts/organ/Aggorg.sf2
+
+music21, torch, fluidsynth and pyaudio take seconds to import, so this
+module imports them only inside the commands that need them. serve keeps
+the imports and the loaded SoundFonts of a SynthPool in one process and
+runs jobs sent as JSON lines (with a "profile" key for the
+instrumentation of a job), e.g.
+
+    {"command": "render", "input": "song.mid", "output": "song.wav", "soundfont": "soundfonts/organ/Aggorg.sf2"}
+
+over stdin or a Unix socket. Every job gets one JSON line as an answer.
+"""
+import os
+import sys
+import json
+import argparse
+from typing import Any, Dict, Optional, TextIO
+
+DEFAULT_SOUNDFONT = "soundfonts/organ/Aggorg.sf2"
+
+
+def compose(output: str, seed: Optional[int] = None) -> Dict[str, Any]:
+    """Writes a composition of the RandomComposer as a MIDI file."""
+    import random
+    from random_composer import RandomComposer
+
+    melody = RandomComposer().compose(random.Random(seed))
+    melody.write("midi", fp=output)
+    return {"output": output, "quarter_length": float(melody.highestTime)}
+
+
+def _load_midi(filename: str):
+    from music21 import converter
+
+    return converter.parse(filename, format="midi")
+
+
+def _write_wav(filename: str, waveform, sample_rate: int):
+    """Writes an interleaved stereo waveform in the range of int16 as a 16 bit WAV file."""
+    import wave
+    import numpy as np
+
+    samples = np.clip(waveform, -32768, 32767).astype("<i2")
+    with wave.open(filename, "wb") as wav_file:
+        wav_file.setnchannels(2)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples.tobytes())
+
+
+def parts_pool():
+    """A SynthPool of synths with a MIDI channel for every part, as render_parts needs them."""
+    from midi2wave import create_multichannel_fluidsynth
+    from synth_pool import SynthPool
+
+    return SynthPool(synth_factory=create_multichannel_fluidsynth, midi_channels=16)
+
+
+def render(input: str, output: str, soundfont: str = DEFAULT_SOUNDFONT, pool=None) -> Dict[str, Any]:
+    """
+    Renders a MIDI file to a WAV file. Every track plays on its own MIDI
+    channel with its program. A pool from parts_pool, e.g. the one of serve,
+    keeps the SoundFont loaded for the next job.
+    """
+    from midi2wave import render_parts
+
+    melody = _load_midi(input)
+    own_pool = pool is None
+    if own_pool:
+        pool = parts_pool()
+    try:
+        with pool.synth(soundfont) as (synth, sfid):
+            waveform = render_parts(melody, synth, soundfont, sfids={soundfont: sfid})
+    finally:
+        if own_pool:
+            pool.close()
+    _write_wav(output, waveform, 44100)
+    return {"output": output, "seconds": len(waveform) / 2 / 44100}
+
+
+def build_dataset(directory: str, examples: int, soundfont_directory: str = "soundfonts",
+                  seed: Optional[int] = None, pool=None) -> Dict[str, Any]:
+    from stem_dataset import StemDataset, build_stem_dataset, find_soundfonts
+
+    build_stem_dataset(directory, examples, find_soundfonts(soundfont_directory), seed=seed, pool=pool)
+    return {"directory": directory, "examples": len(StemDataset(directory))}
+
+
+def play(input: Optional[str] = None, soundfont: str = DEFAULT_SOUNDFONT,
+         seed: Optional[int] = None) -> Dict[str, Any]:
+    """Plays a MIDI file, or a new composition without input, while it is synthesized."""
+    import random
+    from midi2wave import create_fluidsynth, waveform_blocks
+    from realtime import RealtimeEngine, IteratorSource, PyAudioSink, interleaved_to_frames
+
+    if input is not None:
+        melody = _load_midi(input)
+    else:
+        from random_composer import RandomComposer
+
+        melody = RandomComposer().compose(random.Random(seed))
+    synth = create_fluidsynth(start=False)
+    try:
+        blocks = waveform_blocks(melody, synth, soundfont, block_size=1024)
+        engine = RealtimeEngine(IteratorSource(interleaved_to_frames(b) for b in blocks), PyAudioSink())
+        engine.start()
+        engine.wait()
+    finally:
+        synth.delete()
+    return {"frames": engine.frames_played, "xruns": engine.xruns}
+
+
+COMMANDS = {
+    "compose": compose,
+    "render": render,
+    "build-dataset": build_dataset,
+    "play": play,
+}
+# The pool of serve each pooled command gets: render needs multichannel synths
+POOLED_COMMANDS = {"render": "parts", "build-dataset": "voices"}
+
+
+def run_job(job: Dict[str, Any], pools: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Runs one job of serve. The keys of the job are the command and the
+    parameters of its function. With "profile" the instrumentation of the
+    job gets saved to that file. pools maps the values of POOLED_COMMANDS
+    to SynthPools.
+    """
+    job = dict(job)
+    command = job.pop("command", None)
+    if command not in COMMANDS:
+        raise ValueError(f"Unknown command {command!r}, expected one of {', '.join(COMMANDS)}.")
+    profile = job.pop("profile", None)
+    if command in POOLED_COMMANDS and pools is not None:
+        job["pool"] = pools[POOLED_COMMANDS[command]]
+    if profile is None:
+        return COMMANDS[command](**job)
+    from instrumentation import profile_job
+
+    with profile_job(command) as recorder:
+        result = COMMANDS[command](**job)
+    recorder.save(profile, chrome_trace=profile.endswith(".trace.json"))
+    return result
+
+
+def _answer(job_line: str, pools) -> str:
+    try:
+        result = run_job(json.loads(job_line), pools)
+    except Exception as e:
+        return json.dumps({"ok": False, "error": f"{type(e).__name__}: {e}"})
+    return json.dumps({"ok": True, **result})
+
+
+def _serve_lines(lines: TextIO, answers: TextIO, pools):
+    for line in lines:
+        if line.strip() == "":
+            continue
+        answers.write(_answer(line, pools) + "\n")
+        answers.flush()
+
+
+def serve(socket_path: Optional[str] = None, preload: tuple = ()):
+    """
+    Keeps the heavy imports and the SynthPools resident and runs jobs from
+    stdin or, with socket_path, from the connections of a Unix socket, one
+    job at a time. The preloaded SoundFonts get loaded into both pools.
+    """
+    import socketserver
+    import music21  # noqa: F401 - imported once for all jobs
+    import midi2wave  # noqa: F401
+    import random_composer  # noqa: F401
+    from synth_pool import SynthPool
+
+    pools = {"parts": parts_pool(), "voices": SynthPool()}
+    for pool in pools.values():
+        for soundfont in preload:
+            pool.checkin(pool.checkout(soundfont)[0])
+    try:
+        if socket_path is None:
+            _serve_lines(sys.stdin, sys.stdout, pools)
+            return
+
+        class JobHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip() == b"":
+                        continue
+                    self.wfile.write((_answer(line.decode(), pools) + "\n").encode())
+                    self.wfile.flush()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        with socketserver.UnixStreamServer(socket_path, JobHandler) as server:
+            print(f"Serving on {socket_path}", file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(socket_path)
+    finally:
+        for pool in pools.values():
+            pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="automarti", description="Compose, render and play music for Automarti.")
+    parser.add_argument("--profile", help="Save the instrumentation of the command to this JSON file "
+                                          "(a Chrome trace if it ends in .trace.json).")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compose_parser = commands.add_parser("compose", help="Write a random composition as a MIDI file.")
+    compose_parser.add_argument("output")
+    compose_parser.add_argument("--seed", type=int)
+
+    render_parser = commands.add_parser("render", help="Render a MIDI file to WAV.")
+    render_parser.add_argument("input")
+    render_parser.add_argument("output")
+    render_parser.add_argument("--soundfont", default=DEFAULT_SOUNDFONT)
+
+    dataset_parser = commands.add_parser("build-dataset", help="Render random compositions to a stem dataset.")
+    dataset_parser.add_argument("directory")
+    dataset_parser.add_argument("--examples", type=int, default=100)
+    dataset_parser.add_argument("--soundfont-directory", default="soundfonts")
+    dataset_parser.add_argument("--seed", type=int)
+
+    play_parser = commands.add_parser("play", help="Play a MIDI file or a new composition.")
+    play_parser.add_argument("input", nargs="?")
+    play_parser.add_argument("--soundfont", default=DEFAULT_SOUNDFONT)
+    play_parser.add_argument("--seed", type=int)
+
+    serve_parser = commands.add_parser("serve", help="Run JSON jobs from stdin or a Unix socket in a warm process.")
+    serve_parser.add_argument("--socket", dest="socket_path")
+    serve_parser.add_argument("--preload", nargs="*", default=[], help="SoundFonts to load before the first job.")
+
+    job = vars(parser.parse_args(argv))
+    if job["command"] == "serve":
+        if job["profile"] is not None:
+            parser.error("--profile does not apply to serve, give a job a \"profile\" key instead.")
+        serve(job["socket_path"], tuple(job["preload"]))
+        return
+    if job["profile"] is None:
+        del job["profile"]
+    print(json.dumps(run_job(job)))
+
+
+if __name__ == "__main__":
+    main()
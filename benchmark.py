@@ -0,0 +1,224 @@
+import gc
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import argparse
+import multiprocessing
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Optional
+import numpy as np
+
+SAMPLE_RATE = 44100
+
+
+class Skip(Exception):
+    pass
+
+
+def seed_everything(seed: int = 0):
+    random.seed(seed)
+    np.random.seed(seed)
+    # Only seed torch for benchmarks which use it, importing it would dominate the RSS of the others
+    if "torch" in sys.modules:
+        sys.modules["torch"].manual_seed(seed)
+
+
+def measure(run: Callable[[], Optional[Dict[str, float]]], repeats: int,
+            min_seconds: float = 1.0) -> Dict[str, float]:
+    """
+    Times run at least repeats times and for at least min_seconds in total
+    (best wall time counts, the median shows the jitter of the machine) and runs it once more under tracemalloc for the allocation numbers.
+    retained_blocks are the traced memory blocks still alive after that run.
+    run may return "audio_seconds" and "events", which become realtime
+    factor and events/s. peak_rss_bytes is the peak of the whole process,
+    run_benchmarks gives every benchmark its own process for it.
+    """
+    times = []
+    info: Dict[str, float] = {}
+    while len(times) < repeats or sum(times) < min_seconds:
+        seed_everything()
+        gc.collect()
+        start = time.perf_counter()
+        info = run() or {}
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    seed_everything()
+    tracemalloc.start()
+    run()
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    retained_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+    result = {"seconds": best,
+              "median_seconds": float(np.median(times)),
+              "runs": len(times),
+              "alloc_peak_bytes": alloc_peak,
+              "retained_blocks": retained_blocks,
+              "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    if "audio_seconds" in info:
+        result["realtime_factor"] = info["audio_seconds"] / best
+    if "events" in info:
+        result["events_per_second"] = info["events"] / best
+    return result
+
+
+def bench_circle_of_fifths():
+    from circle_of_fiths import CircleOfFifths
+    for _ in range(100):
+        CircleOfFifths()
+
+
+def bench_build_chord_and_select_inversion():
+    from music21.note import Note
+    from circle_of_fiths import major, minor, PITCHES
+    from random_composer import build_chord_and_select_inversion
+    prev = Note(60)
+    for i in range(50):
+        chord = build_chord_and_select_inversion(Note(PITCHES[i % 12]), (major, minor)[i % 2], prev)
+        prev = sorted(chord.notes, key=lambda n: n.pitch)[0]
+    prev = 60
+    for i in range(5000):
+        prev = min(build_chord_and_select_inversion(PITCHES[i % 12], (major, minor)[i % 2], prev))
+
+
+def bench_create_rhythm():
+    from random_composer import create_rhythm
+    for _ in range(20):
+        create_rhythm()
+
+
+def bench_compose_movement():
+    import torch
+    from emotional_narrative import EmotionSequenceGenerator
+    from movement_composer import MovementComposer
+    emotions = EmotionSequenceGenerator().generate_sequence(64, generator=torch.Generator().manual_seed(0))
+    for _ in range(10):
+        MovementComposer(emotions, key_init=0, instrument_types=["organ", "piano", "strings"]).compose_movement(2)
+
+
+def bench_part_to_waveform(stream_name: str):
+    from benchmark_fixtures import STREAMS, sine_soundfont
+    try:
+        from midi2wave import create_fluidsynth, part_to_waveform, compile_stream
+    except (ImportError, OSError) as e:
+        raise Skip(f"pyfluidsynth is not usable: {e}")
+    melody = STREAMS[stream_name]()
+    soundfont_filename = sine_soundfont()
+    events = len(compile_stream(melody, SAMPLE_RATE).time)
+
+    def run():
+        synth = create_fluidsynth(start=False)
+        waveform = part_to_waveform(melody, synth, soundfont_filename, SAMPLE_RATE)
+        synth.delete()
+        return {"audio_seconds": len(waveform) / 2 / SAMPLE_RATE, "events": events}
+    return run
+
+
+def bench_sample_generator():
+    if shutil.which("fluidsynth") is None:
+        raise Skip("The fluidsynth command is not installed.")
+    from benchmark_fixtures import STREAMS, sine_soundfont
+    from fluidsynth_subprocess import sample_generator
+    melody = STREAMS["short"]()
+    soundfont_filename = sine_soundfont()
+
+    def run():
+        frames = sum(chunk.shape[1] for chunk in sample_generator(melody, soundfont_filename, in_memory=True))
+        return {"audio_seconds": frames / SAMPLE_RATE}
+    return run
+
+
+def bench_mixing():
+    from mixing import augment, to_int16
+    rng = np.random.default_rng(0)
+    stems = rng.uniform(-0.3, 0.3, (32, 4, 2, 4 * SAMPLE_RATE)).astype(np.float32)
+    mixes = np.empty((32, 2, 4 * SAMPLE_RATE), dtype=np.float32)
+    pcm = np.empty((32, 4 * SAMPLE_RATE, 2), dtype=np.int16)
+
+    def run():
+        augment(stems, rng, mixes, max_shift=SAMPLE_RATE // 10)
+        to_int16(mixes, pcm)
+        return {"audio_seconds": 32 * 4}
+    return run
+
+
+# name -> (function, repeats). Functions taking no time to set up return None
+# and are measured directly, others return the function to measure.
+BENCHMARKS = {
+    "circle_of_fifths": (bench_circle_of_fifths, 5),
+    "build_chord_and_select_inversion": (bench_build_chord_and_select_inversion, 5),
+    "create_rhythm": (bench_create_rhythm, 3),
+    "compose_movement": (bench_compose_movement, 3),
+    "part_to_waveform_short": (lambda: bench_part_to_waveform("short"), 5),
+    "part_to_waveform_long": (lambda: bench_part_to_waveform("long"), 2),
+    "part_to_waveform_dense": (lambda: bench_part_to_waveform("dense"), 2),
+    "sample_generator": (bench_sample_generator, 3),
+    "mixing": (bench_mixing, 3),
+}
+SETUP_BENCHMARKS = {"part_to_waveform_short", "part_to_waveform_long", "part_to_waveform_dense", "sample_generator",
+                    "mixing"}
+
+
+def run_benchmark(name: str) -> Dict[str, float]:
+    function, repeats = BENCHMARKS[name]
+    try:
+        run = function() if name in SETUP_BENCHMARKS else function
+        return measure(run, repeats)
+    except Skip as e:
+        return {"skipped": str(e)}
+
+
+def run_benchmarks(selected=None) -> Dict[str, Dict[str, float]]:
+    """Runs every benchmark in a fresh process, so peak RSS and imports don't carry over."""
+    results = {}
+    for name in BENCHMARKS:
+        if selected and name not in selected:
+            continue
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results[name] = executor.submit(run_benchmark, name).result()
+        print(f"{name}: {results[name]}", file=sys.stderr)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float,
+            noise_floor: float = 0.005) -> bool:
+    """
+    Prints the time ratio of every benchmark to the baseline. Returns False on
+    a regression, i.e. a slowdown by more than threshold which is also larger
+    than the noise: noise_floor seconds or the jitter (median - best) of both
+    runs, whichever is larger. Millisecond benchmarks jitter by more than 10 %.
+    """
+    ok = True
+    for name, result in results.items():
+        if "seconds" not in result or "seconds" not in baseline.get(name, {}):
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        noise = max(noise_floor, sum(r.get("median_seconds", r["seconds"]) - r["seconds"]
+                                     for r in (result, baseline[name])))
+        regression = ratio > 1 + threshold and result["seconds"] - baseline[name]["seconds"] > noise
+        ok &= not regression
+        print(f"{name:40s} {ratio:6.2f}x {'REGRESSION' if regression else ''}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the composition and rendering hot paths.")
+    parser.add_argument("benchmarks", nargs="*", help="Names of benchmarks to run (default: all).")
+    parser.add_argument("--save", help="Write the results as JSON to this file, e.g. as a baseline.")
+    parser.add_argument("--compare", help="Compare with the results in this JSON file.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Allowed slowdown before failing (0.1 = 10%%).")
+    parser.add_argument("--noise-floor", type=float, default=0.005,
+                        help="Slowdowns of fewer seconds never count as regressions.")
+    args = parser.parse_args()
+    bench_results = run_benchmarks(args.benchmarks)
+    print(json.dumps(bench_results, indent=2))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(bench_results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(bench_results, json.load(f), args.threshold, args.noise_floor):
+                sys.exit(1)
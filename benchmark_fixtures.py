@@ -0,0 +1,87 @@
+import os
+import random
+import struct
+import numpy as np
+from music21.note import Note
+from music21.chord import Chord
+from music21.tempo import MetronomeMark
+from music21.stream import Stream
+
+SINE_SAMPLE_RATE = 44000  # 440 Hz has exactly 100 samples per period
+SINE_PERIODS = 16
+
+
+def _chunk(chunk_id: bytes, data: bytes) -> bytes:
+    if len(data) % 2 == 1:
+        data += b"\0"
+    return chunk_id + struct.pack("<I", len(data)) + data
+
+
+def _list(list_type: bytes, *chunks: bytes) -> bytes:
+    return _chunk(b"LIST", list_type + b"".join(chunks))
+
+
+def _name(name: str) -> bytes:
+    return name.encode("ascii")[:19].ljust(20, b"\0")
+
+
+def write_sine_soundfont(filename: str):
+    """
+    Writes a tiny SoundFont with one preset (bank 0, program 0) playing a
+    looped sine wave, so benchmarks do not depend on downloaded SoundFonts.
+    """
+    period = SINE_SAMPLE_RATE // 440
+    samples = (np.sin(2 * np.pi * np.arange(period * SINE_PERIODS) / period) * 16000).astype('<i2')
+    sample_data = samples.tobytes() + b"\0" * 2 * 46  # The specification wants 46 zero samples after every sample
+    info = _list(b"INFO",
+                 _chunk(b"ifil", struct.pack("<HH", 2, 1)),
+                 _chunk(b"isng", b"EMU8000\0"),
+                 _chunk(b"INAM", b"Automarti sine\0"))
+    sdta = _list(b"sdta", _chunk(b"smpl", sample_data))
+    pdta = _list(b"pdta",
+                 _chunk(b"phdr", _name("Sine") + struct.pack("<HHHIII", 0, 0, 0, 0, 0, 0)
+                        + _name("EOP") + struct.pack("<HHHIII", 0, 0, 1, 0, 0, 0)),
+                 _chunk(b"pbag", struct.pack("<HH", 0, 0) + struct.pack("<HH", 1, 0)),
+                 _chunk(b"pmod", b"\0" * 10),
+                 _chunk(b"pgen", struct.pack("<Hh", 41, 0) + struct.pack("<Hh", 0, 0)),  # instrument 0
+                 _chunk(b"inst", _name("Sine") + struct.pack("<H", 0) + _name("EOI") + struct.pack("<H", 1)),
+                 _chunk(b"ibag", struct.pack("<HH", 0, 0) + struct.pack("<HH", 3, 0)),
+                 _chunk(b"imod", b"\0" * 10),
+                 _chunk(b"igen", struct.pack("<Hh", 38, -3986)  # releaseVolEnv 0.1 s
+                        + struct.pack("<Hh", 54, 1)  # sampleModes: loop
+                        + struct.pack("<Hh", 53, 0)  # sampleID
+                        + struct.pack("<Hh", 0, 0)),
+                 _chunk(b"shdr", _name("Sine") + struct.pack("<IIIIIBbHH", 0, len(samples), 4 * period,
+                                                             12 * period, SINE_SAMPLE_RATE, 69, 0, 0, 1)
+                        + _name("EOS") + struct.pack("<IIIIIBbHH", 0, 0, 0, 0, 0, 0, 0, 0, 0)))
+    with open(filename, "wb") as f:
+        f.write(_chunk(b"RIFF", b"sfbk" + info + sdta + pdta))
+
+
+def sine_soundfont(directory: str = ".benchmark") -> str:
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, "sine.sf2")
+    if not os.path.exists(filename):
+        write_sine_soundfont(filename)
+    return filename
+
+
+def melody(notes: int, seed: int = 0) -> Stream:
+    """A monophonic line of quarters and eighths."""
+    rng = random.Random(seed)
+    return Stream([MetronomeMark(number=120)] +
+                  [Note(rng.randint(55, 79), quarterLength=rng.choice((0.5, 1.0))) for _ in range(notes)])
+
+
+def dense_chords(chords: int, seed: int = 0) -> Stream:
+    """Six-note sixteenth chords, many events per second."""
+    rng = random.Random(seed)
+    return Stream([MetronomeMark(number=160)] +
+                  [Chord(sorted(rng.sample(range(40, 90), 6)), quarterLength=0.25) for _ in range(chords)])
+
+
+STREAMS = {
+    "short": lambda: melody(16),
+    "long": lambda: melody(2000),
+    "dense": lambda: dense_chords(1000),
+}
@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-from music21.note import Note
+import numpy as np
+from functools import lru_cache
+from numpy.typing import NDArray, ArrayLike
 from enum import Enum
 
 
@@ -13,24 +15,93 @@ major = MajorMinor.MAJOR
 minor = MajorMinor.MINOR
 
 
+# MIDI pitches of the base notes in octave 4, ordered like CircleOfFifths.notes
+PITCHES = (60, 67, 62, 69, 64, 71, 66, 61, 68, 63, 70, 65)
+NOTE_NAMES = ('C4', 'G4', 'D4', 'A4', 'E4', 'B4', 'F#4', 'D-4', 'A-4', 'E-4', 'B-4', 'F4')
+
+
+def base_pitch(index: int, major_minor: MajorMinor = major) -> int:
+    if major_minor == major:
+        return PITCHES[index % 12]
+    elif major_minor == minor:
+        return PITCHES[(index + 3) % 12]
+
+
+def circle_index(pitch: int) -> int:
+    """Position of the pitch class of a MIDI pitch in PITCHES."""
+    return (pitch * 7) % 12
+
+
+@lru_cache(maxsize=None)
+def chord_table() -> NDArray[np.int16]:
+    """
+    MIDI pitches of all triads with shape (mode, circle index, inversion, voice).
+    The mode is indexed by MajorMinor.value. The voices are in the order of
+    random_composer.build_chord and every chord is transposed so its lowest
+    note is in octave 4.
+    """
+    table = np.zeros((2, 12, 3, 3), dtype=np.int16)
+    for mode in MajorMinor:
+        third = 4 if mode == major else 3
+        for index, pitch in enumerate(PITCHES):
+            for inversion in range(3):
+                chord = np.array([pitch + (12 if inversion >= 1 else 0),
+                                  pitch + third + (12 if inversion >= 2 else 0),
+                                  pitch + 7])
+                table[mode.value, index, inversion] = chord - 12 * (chord.min() // 12 - 5)
+    return table
+
+
+@lru_cache(maxsize=None)
+def inversion_table() -> NDArray[np.int8]:
+    """
+    The inversion whose lowest note is closest to the previous bass with the
+    shape (mode, circle index, previous bass as MIDI pitch).
+    """
+    bass = chord_table().min(axis=3).astype(np.int32)
+    distances = np.abs(bass[:, :, :, np.newaxis] - np.arange(128)[np.newaxis, np.newaxis, np.newaxis, :])
+    return np.argmin(distances, axis=2).astype(np.int8)
+
+
+def voice_progression(indices: ArrayLike, modes: ArrayLike, prev_bass: int) -> NDArray[np.int16]:
+    """
+    Selects the inversion of every chord of a progression so the bass moves
+    as little as possible and returns the MIDI pitches with shape (chords, 3).
+
+    Parameters:
+    - indices: circle indices of the chords.
+    - modes: MajorMinor.value of the chords.
+    - prev_bass: MIDI pitch of the bass before the first chord.
+    """
+    indices = np.asarray(indices, dtype=np.int64) % 12
+    modes = np.asarray(modes, dtype=np.int64)
+    chords, inversions = chord_table(), inversion_table()
+    if len(indices) == 0:
+        return np.zeros((0, 3), dtype=np.int16)
+    bass_class = chords.min(axis=3) - 60  # All basses are in octave 4
+    # For every chord map each of the 12 possible previous basses to its bass
+    transitions = bass_class[modes[:, np.newaxis], indices[:, np.newaxis],
+                             inversions[modes[:, np.newaxis], indices[:, np.newaxis], np.arange(60, 72)]]
+    # Compose the maps with a parallel prefix scan, afterwards row i maps the first bass to the bass of chord i
+    scan = transitions[1:]
+    step = 1
+    while step < len(scan):
+        scan = np.concatenate([scan[:step], np.take_along_axis(scan[step:], scan[:-step], axis=1)])
+        step *= 2
+    first_inversion = inversions[modes[0], indices[0], prev_bass]
+    first_bass = bass_class[modes[0], indices[0], first_inversion]
+    prev_basses = np.empty(len(indices), dtype=np.int64)
+    prev_basses[0] = prev_bass
+    prev_basses[1:2] = 60 + first_bass
+    prev_basses[2:] = 60 + scan[:-1, first_bass]
+    return chords[modes, indices, inversions[modes, indices, prev_basses]]
+
+
 class CircleOfFifths:
     def __init__(self):
-        base_note = Note('C4', quarterLength=4)
-        self.notes = [base_note]
-        for i in range(6):
-            new_note = base_note.transpose('P5')
-            while new_note.octave > 4:
-                new_note = new_note.transpose('P-8')
-            self.notes.append(new_note)
-            base_note = new_note
-        base_note = Note('D4-', quarterLength=4)
-        self.notes.append(base_note)
-        for i in range(4):
-            new_note = base_note.transpose('P5')
-            while new_note.octave > 4:
-                new_note = new_note.transpose('P-8')
-            self.notes.append(new_note)
-            base_note = new_note
+        # music21 takes seconds to import, so only the CircleOfFifths object needs it
+        from music21.note import Note
+        self.notes = [Note(name, quarterLength=4) for name in NOTE_NAMES]
 
     def base_note(self, index: int, major_minor: MajorMinor = major):
         if major_minor == major:
@@ -1,18 +1,101 @@
+import numpy as np
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+from numpy.typing import NDArray
 from pedalboard.io import AudioFile
 from pedalboard import Pedalboard
-from pedalboard import Compressor, load_plugin
+from pedalboard import Compressor, Reverb, load_plugin
+
+# Names used in EffectChange -> (plugin attribute of StreamingEffectChain, parameter, minimum, maximum)
+EFFECT_PARAMETERS = {
+    "reverb": ("reverb", "wet_level", 0.0, 1.0),
+    "room_size": ("reverb", "room_size", 0.0, 1.0),
+    "compression": ("compressor", "ratio", 1.0, 20.0),
+    "threshold": ("compressor", "threshold_db", -60.0, 0.0),
+}
+
+
+def read_chunks(audio_file: AudioFile, chunk_size: int) -> Iterator[NDArray[np.float32]]:
+    while audio_file.tell() < audio_file.frames:
+        yield audio_file.read(chunk_size)
+
+
+def effect_timeline(composition: Sequence[Sequence[object]], samples_per_step: int) -> List[Tuple[int, Dict[str, float]]]:
+    """
+    Converts the EffectChange modifiers of a MovementComposer composition to
+    a timeline of (sample position, effect changes).
+    """
+    return [(step * samples_per_step, modifier.effect_changes)
+            for step, modifiers in enumerate(composition)
+            for modifier in modifiers if hasattr(modifier, "effect_changes")]
+
+
+class StreamingEffectChain:
+    """
+    Runs chunks of audio with the shape (channels, frames) through one
+    persistent Pedalboard. The plugins are never reset between chunks, so
+    reverb and compressor tails continue across chunk boundaries. Parameter
+    changes from the timeline are applied exactly at their sample position
+    by splitting the chunk there.
+
+    Usage:
+        chain = StreamingEffectChain(44100, timeline=[(88200, {"reverb": +0.5})])
+        for chunk in chain.stream(sample_generator(music_stream, soundfont_filename)):
+            ...
+    """
+    def __init__(self, sample_rate: float = 44100, timeline: Iterable[Tuple[int, Dict[str, float]]] = ()):
+        self.sample_rate = sample_rate
+        self.reverb = Reverb(wet_level=0.0, dry_level=1.0)
+        self.compressor = Compressor(threshold_db=0.0)
+        self.board = Pedalboard([self.reverb, self.compressor])
+        self.timeline = sorted(timeline, key=lambda change: change[0])
+        self.next_change = 0
+        self.position = 0  # Samples processed so far
+
+    def apply_changes(self, effect_changes: Dict[str, float]):
+        for name, delta in effect_changes.items():
+            plugin_name, parameter, minimum, maximum = EFFECT_PARAMETERS[name]
+            plugin = getattr(self, plugin_name)
+            setattr(plugin, parameter, float(np.clip(getattr(plugin, parameter) + delta, minimum, maximum)))
+
+    def process(self, chunk: NDArray[np.float32]) -> NDArray[np.float32]:
+        frames = chunk.shape[-1]
+        if frames == 0:
+            return chunk
+        parts = []
+        start = 0
+        while self.next_change < len(self.timeline) and self.timeline[self.next_change][0] < self.position + frames:
+            change_pos = max(self.timeline[self.next_change][0] - self.position, 0)
+            if change_pos > start:
+                parts.append(self.board(chunk[..., start:change_pos], self.sample_rate, reset=False))
+                start = change_pos
+            self.apply_changes(self.timeline[self.next_change][1])
+            self.next_change += 1
+        if start < frames:
+            parts.append(self.board(chunk[..., start:], self.sample_rate, reset=False))
+        self.position += frames
+        return parts[0] if len(parts) == 1 else np.concatenate(parts, axis=-1)
+
+    def process_frames(self, block: NDArray[np.float32]) -> NDArray[np.float32]:
+        """For blocks with the shape (frames, channels), e.g. as an effect of the RealtimeEngine."""
+        return self.process(np.ascontiguousarray(block.T)).T
+
+    def stream(self, chunks: Iterable[NDArray[np.float32]]) -> Iterator[NDArray[np.float32]]:
+        for chunk in chunks:
+            yield self.process(chunk)
+
+    def flush(self, seconds: float = 2.0, channels: int = 2) -> NDArray[np.float32]:
+        """Renders the tails of the effects after the last chunk."""
+        return self.process(np.zeros((channels, int(seconds * self.sample_rate)), dtype=np.float32))
 
 
 if __name__ == "__main__":
+    from realtime import RealtimeEngine, IteratorSource, PyAudioSink
     with AudioFile('samples/budumdumdidum.mp3') as f:
-        audio = f.read(f.frames)
-    print(type(audio), audio.shape, audio.dtype)
-
-    import pyaudio
-    pa = pyaudio.PyAudio()
-    pa_strm = pa.open(
-        format=pyaudio.paInt16,
-        channels=2,
-        rate=44100,
-        output=True)
-    pa_strm.write(audio)
+        sample_rate = int(f.samplerate)
+        channels = f.num_channels
+        chain = StreamingEffectChain(sample_rate, timeline=[(2 * sample_rate, {"reverb": +0.5})])
+        # AudioFile gives float32 chunks with the shape (channels, frames)
+        chunks = (chunk.T for chunk in chain.stream(read_chunks(f, 4096)))
+        engine = RealtimeEngine(IteratorSource(chunks), PyAudioSink(), sample_rate=sample_rate, channels=channels)
+        engine.start()
+        engine.wait()
@@ -1,4 +1,6 @@
+import math
 import torch
+from typing import Optional
 
 
 class EmotionSequenceGenerator:
@@ -9,17 +11,50 @@ class EmotionSequenceGenerator:
         "Happyness": {'min': -1.0, 'max': 1.0},
         "Randomness": {'min': 0.0, 'max': 1.0}
     }
+    MODES = ("uniform", "random_walk", "smooth")
+    LOW = torch.tensor([d['min'] for d in DIMENSIONS.values()])
+    SCALE = torch.tensor([d['max'] - d['min'] for d in DIMENSIONS.values()])
 
-    def generate_sequence(self, seq_len):
-        emo_dims = []
-        for i, dimension in enumerate(self.DIMENSIONS):
-            emo_dims.append(torch.distributions.uniform.Uniform(
-                low=self.DIMENSIONS[dimension]['min'],
-                high=self.DIMENSIONS[dimension]['max']).sample([seq_len]))
-        return torch.stack(emo_dims, dim=1)
+    def generate_sequence(self, seq_len, generator: Optional[torch.Generator] = None):
+        return self.generate_batch(1, seq_len, generator=generator)[0]
+
+    def generate_batch(self, batch: int, seq_len: int, generator: Optional[torch.Generator] = None,
+                       mode: str = "uniform", step_size: float = 0.1, key_distance: int = 4) -> torch.Tensor:
+        """
+        Generates a batch of emotion sequences with the shape (batch, seq_len, 5).
+
+        Modes:
+        - uniform: every step is drawn independently.
+        - random_walk: steps of at most step_size (relative to the range of a
+          dimension) reflected at the borders of the range.
+        - smooth: random key points every key_distance steps, linearly interpolated.
+        """
+        if mode == "uniform":
+            unit = torch.rand(batch, seq_len, len(self.DIMENSIONS), generator=generator)
+        elif mode == "random_walk":
+            steps = torch.rand(batch, seq_len, len(self.DIMENSIONS), generator=generator) * 2 - 1
+            steps[:, 1:] *= step_size
+            if seq_len > 0:
+                steps[:, 0] = (steps[:, 0] + 1) / 2  # The start is uniform in the range
+            # Folding the unbounded walk with a triangle wave reflects it at 0 and 1
+            folded = torch.remainder(torch.cumsum(steps, dim=1), 2)
+            unit = torch.where(folded > 1, 2 - folded, folded)
+        elif mode == "smooth" and seq_len == 0:
+            unit = torch.empty(batch, 0, len(self.DIMENSIONS))  # interpolate can't make empty outputs
+        elif mode == "smooth":
+            key_points = torch.rand(batch, len(self.DIMENSIONS), math.ceil(seq_len / key_distance) + 1,
+                                    generator=generator)
+            unit = torch.nn.functional.interpolate(key_points, size=seq_len, mode='linear',
+                                                   align_corners=True).transpose(1, 2)
+        else:
+            raise ValueError(f"Unknown mode {mode}. Use one of {', '.join(self.MODES)}.")
+        return self.LOW + unit * self.SCALE
 
 
 if __name__ == "__main__":
     generator = EmotionSequenceGenerator()
     emotions = generator.generate_sequence(10)
     print(emotions)
+    g = torch.Generator().manual_seed(42)
+    for mode in generator.MODES:
+        print(mode, generator.generate_batch(1000, 64, generator=g, mode=mode).shape)
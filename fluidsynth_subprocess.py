@@ -1,32 +1,243 @@
+import os
 import subprocess
 import tempfile
 import numpy as np
-from typing import Iterator
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from queue import Queue
+from typing import Iterator, Optional
 from numpy.typing import NDArray
 from music21.stream import Stream
+from music21.midi import MidiFile
 from music21.midi.translate import streamToMidiFile
 from pedalboard.io import AudioFile
+from render_cache import RenderCache, render_key
+from instrumentation import count, span
+
+FLUIDSYNTH_CLI_GAIN = 0.2  # Default of synth.gain
+
+
+def _piped_sample_generator(midi_bytes: bytes, soundfont_filename: str,
+                            chunk_size_in_seconds: float = 5.0,
+                            sample_rate: int = 44100) -> Iterator[NDArray[np.float32]]:
+    # fluidsynth wants a seekable MIDI file, so it gets an anonymous in-memory file instead of a pipe
+    midi_fd = os.memfd_create("automarti.mid")
+    try:
+        os.write(midi_fd, midi_bytes)
+        count("bytes_written", len(midi_bytes))
+        process = subprocess.Popen(
+            ['fluidsynth', '-niq', soundfont_filename, f'/dev/fd/{midi_fd}',
+             '-F', '-', '-T', 'raw', '-O', 'float', '-r', str(sample_rate)],
+            stdout=subprocess.PIPE, pass_fds=(midi_fd,))
+    finally:
+        os.close(midi_fd)
+    finished = False
+    try:
+        # Raw output is interleaved stereo float32
+        chunk_size_in_bytes = int(chunk_size_in_seconds * sample_rate) * 2 * np.dtype(np.float32).itemsize
+        while True:
+            data = process.stdout.read(chunk_size_in_bytes)
+            if len(data) == 0:
+                break
+            data = data[:len(data) - len(data) % 8]
+            if len(data) == 0:
+                continue
+            count("samples_synthesized", len(data) // 8)
+            yield np.ascontiguousarray(np.frombuffer(data, dtype=np.float32).reshape(-1, 2).T)
+        finished = True
+    finally:
+        if not finished:
+            process.kill()
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, process.args)
+
+
+def _worker_main(connection: Connection, soundfont_filename: str, sample_rate: int, gain: float):
+    # Imported here so the parent process does not need pyfluidsynth for the CLI based modes
+    from midi2wave import create_fluidsynth, compile_schedule, render_into, waveform_size
+    from synth_pool import reset_synth
+    synth = create_fluidsynth(gain, sample_rate, start=False)
+    sfid = synth.sfload(soundfont_filename)
+    synth.program_select(0, sfid, 0, 0)
+    try:
+        while True:
+            try:
+                midi_bytes = connection.recv_bytes()
+            except EOFError:
+                break
+            try:
+                midi_data = MidiFile()
+                midi_data.readstr(midi_bytes)
+                schedule = compile_schedule(midi_data, sample_rate)
+                waveform = render_into(schedule, synth,
+                                       np.empty(waveform_size(schedule, sample_rate), dtype=np.float32),
+                                       sample_rate)
+            except Exception as e:
+                # The job failed, not the worker: report the error and wait for the next job
+                reset_synth(synth, sfid)
+                try:
+                    connection.send(e)
+                except Exception:
+                    connection.send(RuntimeError(repr(e)))
+                continue
+            reset_synth(synth, sfid)
+            connection.send(None)
+            connection.send_bytes(waveform)
+    finally:
+        synth.delete()
+
+
+class FluidsynthWorker:
+    """
+    A long-lived process owning a synth with the SoundFont loaded. MIDI files
+    are sent to it over a pipe and the rendered waveform (interleaved stereo,
+    int16 range, like part_to_waveform) comes back over the same pipe.
+    Errors of a job are raised by render, the worker keeps running. The
+    default gain matches the fluidsynth CLI of the other sample_generator modes.
+    """
+    def __init__(self, soundfont_filename: str, sample_rate: int = 44100, gain: float = FLUIDSYNTH_CLI_GAIN):
+        self.soundfont_filename = soundfont_filename
+        self.sample_rate = sample_rate
+        self.gain = gain
+        self.connection, child_connection = Pipe()
+        self.process = Process(target=_worker_main, args=(child_connection, soundfont_filename, sample_rate, gain),
+                               daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def render(self, midi_bytes: bytes) -> NDArray[np.float32]:
+        self.connection.send_bytes(midi_bytes)
+        error = self.connection.recv()
+        if error is not None:
+            raise error
+        return np.frombuffer(self.connection.recv_bytes(), dtype=np.float32)
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def stop(self):
+        self.connection.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class FluidsynthWorkerPool:
+    """
+    A small pool of FluidsynthWorkers for one SoundFont. Jobs go to the next
+    idle worker. A worker which crashes during a job is replaced and the job
+    is retried once on the new worker.
+    """
+    def __init__(self, soundfont_filename: str, size: int = 2, sample_rate: int = 44100,
+                 gain: float = FLUIDSYNTH_CLI_GAIN):
+        self.soundfont_filename = soundfont_filename
+        self.sample_rate = sample_rate
+        self.gain = gain
+        self.idle: Queue[FluidsynthWorker] = Queue()
+        for _ in range(size):
+            self.idle.put(FluidsynthWorker(soundfont_filename, sample_rate, gain))
+
+    def render(self, midi_bytes: bytes) -> NDArray[np.float32]:
+        worker = self.idle.get()
+        try:
+            try:
+                return worker.render(midi_bytes)
+            except (EOFError, OSError):
+                worker.stop()
+                worker = FluidsynthWorker(self.soundfont_filename, self.sample_rate, self.gain)
+                return worker.render(midi_bytes)
+        finally:
+            if not worker.alive:
+                worker.stop()
+                worker = FluidsynthWorker(self.soundfont_filename, self.sample_rate, self.gain)
+            self.idle.put(worker)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().stop()
 
 
 def sample_generator(music_stream: Stream, soundfont_filename: str,
-                     chunk_size_in_seconds: float = 5.0) -> Iterator[NDArray[np.float32]]:
-    midi_file = streamToMidiFile(music_stream)
+                     chunk_size_in_seconds: float = 5.0, in_memory: bool = False,
+                     worker_pool: Optional[FluidsynthWorkerPool] = None,
+                     cache: Optional[RenderCache] = None,
+                     sample_rate: Optional[int] = None) -> Iterator[NDArray[np.float32]]:
+    """
+    Renders music_stream and yields the audio as (2, frames) float32 chunks
+    of chunk_size_in_seconds. sample_rate defaults to the one of worker_pool
+    or 44100 Hz.
+    """
+    if sample_rate is None:
+        sample_rate = worker_pool.sample_rate if worker_pool is not None else 44100
+    elif worker_pool is not None and worker_pool.sample_rate != sample_rate:
+        raise ValueError(f"The worker pool renders at {worker_pool.sample_rate} Hz, not {sample_rate} Hz.")
+    with span("stream_to_midi"):
+        midi_bytes = streamToMidiFile(music_stream).writestr()
+    if cache is None:
+        yield from _midi_sample_generator(midi_bytes, soundfont_filename, chunk_size_in_seconds, in_memory,
+                                          worker_pool, sample_rate)
+        return
+    gain = worker_pool.gain if worker_pool is not None else FLUIDSYNTH_CLI_GAIN
+    key = render_key(midi_bytes, soundfont_filename, sample_rate, gain)
+    audio = cache.get(key)
+    if audio is None:
+        chunks = []
+        for chunk in _midi_sample_generator(midi_bytes, soundfont_filename, chunk_size_in_seconds, in_memory,
+                                            worker_pool, sample_rate):
+            chunks.append(chunk)
+            yield chunk
+        if len(chunks) > 0:
+            cache.put(key, np.concatenate(chunks, axis=1))
+    else:
+        chunk_size = int(chunk_size_in_seconds * sample_rate)
+        for start in range(0, audio.shape[1], chunk_size):
+            yield audio[:, start:start + chunk_size]
+
+
+def _midi_sample_generator(midi_bytes: bytes, soundfont_filename: str, chunk_size_in_seconds: float,
+                           in_memory: bool, worker_pool: Optional[FluidsynthWorkerPool],
+                           sample_rate: int) -> Iterator[NDArray[np.float32]]:
+    """The uncached part of sample_generator, for a stream already translated to MIDI."""
+    if worker_pool is not None:
+        # Render in an already running worker which has the soundfont loaded
+        if os.path.abspath(worker_pool.soundfont_filename) != os.path.abspath(soundfont_filename):
+            raise ValueError(f"The worker pool has {worker_pool.soundfont_filename} loaded, not {soundfont_filename}.")
+        with span("worker_render"):
+            waveform = worker_pool.render(midi_bytes)
+        count("samples_synthesized", len(waveform) // 2)
+        audio = waveform.reshape(-1, 2).T / np.float32(32768)
+        chunk_size = int(chunk_size_in_seconds * sample_rate)
+        for start in range(0, audio.shape[1], chunk_size):
+            yield audio[:, start:start + chunk_size]
+        return
+    if in_memory:
+        # Stream raw PCM from fluidsynth's stdout while it is rendering, without temporary files
+        yield from _piped_sample_generator(midi_bytes, soundfont_filename, chunk_size_in_seconds, sample_rate)
+        return
     with tempfile.NamedTemporaryFile(suffix=".mid", delete=True) as temp_midi, tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as temp_wav:
-        midi_file.open(temp_midi.name, "wb")
-        midi_file.write()
-        midi_file.close()
+        temp_midi.write(midi_bytes)
+        temp_midi.flush()
+        count("bytes_written", len(midi_bytes))
 
         # Calling fluidsynth to convert MIDI to wav
-        subprocess.run(
-            ['fluidsynth', '-ni', soundfont_filename,
-             temp_midi.name, '-F', temp_wav.name, '-r', '44100']
-        )
+        with span("fluidsynth_cli"):
+            subprocess.run(
+                ['fluidsynth', '-ni', soundfont_filename,
+                 temp_midi.name, '-F', temp_wav.name, '-r', str(sample_rate)]
+            )
 
         # Load the wav file and yield to a numpy array
         with AudioFile(temp_wav.name) as audio_file:
             chunk_size = int(chunk_size_in_seconds * audio_file.samplerate)
+            count("samples_synthesized", audio_file.frames)
             while audio_file.tell() < audio_file.frames:
-                yield audio_file.read(chunk_size)
+                # Not around the yield, the span would time the consumer too
+                with span("wav_read"):
+                    chunk = audio_file.read(chunk_size)
+                yield chunk
 
 
 if __name__ == "__main__":
@@ -43,7 +254,11 @@ if __name__ == "__main__":
                    Note('G4', quarterLength=1),
                    Note('G4', quarterLength=1),
                    Note('C4', quarterLength=1)])
-    sam_gen = sample_generator(strm, 'soundfonts/organ/Aggorg.sf2')
+    sam_gen = sample_generator(strm, 'soundfonts/organ/Aggorg.sf2', in_memory=True)
     for audio in sam_gen:
         print(type(audio), audio.dtype, f"Shape: {audio.shape}")
         print(audio)
+    pool = FluidsynthWorkerPool('soundfonts/organ/Aggorg.sf2', size=1)
+    for audio in sample_generator(strm, 'soundfonts/organ/Aggorg.sf2', worker_pool=pool):
+        print("From worker:", audio.dtype, f"Shape: {audio.shape}")
+    pool.close()
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+class Recorder:
+    """
+    Collects the spans and counters of one job. Spans are kept for a Chrome
+    trace, timings added with add_time only show up in the totals.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.start_ns = time.perf_counter_ns()
+        self.spans: List[Tuple[str, int, int, int]] = []  # name, start, duration (ns), thread id
+        self.totals: Dict[str, List[float]] = {}  # name -> [count, seconds]
+        self.counters: Dict[str, int] = {}
+
+    def add_span(self, name: str, start_ns: int, duration_ns: int):
+        self.spans.append((name, start_ns, duration_ns, threading.get_ident()))
+        self.add_time(name, duration_ns / 1e9)
+
+    def add_time(self, name: str, seconds: float, calls: int = 1):
+        total = self.totals.setdefault(name, [0, 0.0])
+        total[0] += calls
+        total[1] += seconds
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_json(self) -> dict:
+        return {"job": self.name,
+                "seconds": (time.perf_counter_ns() - self.start_ns) / 1e9,
+                "stages": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.totals.items()},
+                "counters": dict(self.counters)}
+
+    def to_chrome_trace(self) -> dict:
+        """The spans in the Trace Event Format of chrome://tracing and Perfetto."""
+        pid = os.getpid()
+        events = [{"name": name, "ph": "X", "pid": pid, "tid": tid,
+                   "ts": (start - self.start_ns) / 1000, "dur": duration / 1000}
+                  for name, start, duration, tid in self.spans]
+        end = (time.perf_counter_ns() - self.start_ns) / 1000
+        events += [{"name": name, "ph": "C", "pid": pid, "ts": end, "args": {name: value}}
+                   for name, value in self.counters.items()]
+        return {"traceEvents": events, "otherData": {"job": self.name}}
+
+    def save(self, filename: str, chrome_trace: bool = False):
+        with open(filename, "w") as f:
+            json.dump(self.to_chrome_trace() if chrome_trace else self.to_json(), f, indent=2)
+
+
+_recorder: ContextVar[Optional[Recorder]] = ContextVar("automarti_recorder", default=None)
+
+
+def current_recorder() -> Optional[Recorder]:
+    return _recorder.get()
+
+
+@contextmanager
+def profile_job(name: str) -> Iterator[Recorder]:
+    """
+    Records all spans and counters of the code inside the with block.
+    Without an active job every hook is a no-op. Threads started inside the
+    block do not inherit the job.
+    """
+    recorder = Recorder(name)
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+class _Span:
+    __slots__ = ("recorder", "name", "start_ns")
+
+    def __init__(self, recorder: Recorder, name: str):
+        self.recorder = recorder
+        self.name = name
+        self.start_ns = 0
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.recorder.add_span(self.name, self.start_ns, time.perf_counter_ns() - self.start_ns)
+
+
+_NO_SPAN = nullcontext()
+
+
+def span(name: str):
+    recorder = _recorder.get()
+    if recorder is None:
+        return _NO_SPAN
+    return _Span(recorder, name)
+
+
+def count(name: str, n: int = 1):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.count(name, n)
+
+
+def timed(name: str, function: Callable) -> Callable:
+    """
+    Wraps function to add its time to the totals of the active job, without
+    a trace span per call. For functions called thousands of times per job,
+    like get_samples. Returns function itself if no job is active.
+    """
+    recorder = _recorder.get()
+    if recorder is None:
+        return function
+
+    @wraps(function)
+    def timed_function(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            recorder.add_time(name, time.perf_counter() - start)
+    return timed_function
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+    """Decorator recording a span for every call of a (non-generator) function."""
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def traced_function(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return traced_function
+    return decorator
+
+
+if __name__ == "__main__":
+    from random_composer import RandomComposer
+    # The composer uses the hooks of the imported module, not those of __main__
+    from instrumentation import profile_job
+
+    with profile_job("compose") as job:
+        RandomComposer().compose()
+    print(json.dumps(job.to_json(), indent=2))
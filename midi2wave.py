@@ -1,100 +1,528 @@
+import heapq
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
-import pyaudio
+from ctypes import POINTER, c_float, c_int, c_void_p
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+from numpy.typing import NDArray, ArrayLike
 import fluidsynth
 from music21.note import Note
+from render_cache import RenderCache, render_key
+from instrumentation import count, span, timed
 from music21.tempo import MetronomeMark
 from music21.meter import TimeSignature
 from music21.stream import Stream
-from music21.midi.translate import streamToMidiFile
-from music21.midi import MidiEvent, DeltaTime, ChannelVoiceMessages
+from music21.midi import MidiFile, DeltaTime, ChannelVoiceMessages, MetaEvents
 
 
-def create_fluidsynth() -> fluidsynth.Synth:
-    # Initialize FluidSynth
-    synth = fluidsynth.Synth(gain=0.98, samplerate=44100, channels=1)
-    synth.start()
+DEFAULT_GAIN = 0.98
+
+
+def create_fluidsynth(gain: float = DEFAULT_GAIN, sample_rate: int = 44100, start: bool = True) -> fluidsynth.Synth:
+    """
+    A synth with one MIDI channel. With start it plays through an audio
+    driver. Synths which only render with get_samples must not start one,
+    the driver would take samples from the same synth.
+    """
+    synth = fluidsynth.Synth(gain=gain, samplerate=sample_rate, channels=1)
+    if start:
+        synth.start()
     return synth
 
 
-def part_to_waveform(melody: Stream, synth: fluidsynth.Synth, soundfont_filename: str, sample_rate: int = 44100):
+def create_multichannel_fluidsynth(audio_groups: int = 1, gain: float = DEFAULT_GAIN,
+                                   sample_rate: int = 44100) -> fluidsynth.Synth:
+    """
+    A synth with 16 MIDI channels for render_parts. With audio_groups > 1
+    every MIDI channel renders into its own stereo output (channel modulo
+    audio_groups), which render_parts uses for stems. No audio driver is
+    started because the synth only renders offline.
+    """
+    return fluidsynth.Synth(gain=gain, samplerate=sample_rate, channels=16,
+                            **{'synth.audio-groups': audio_groups, 'synth.audio-channels': audio_groups})
+
+
+NOTE_ON = int(ChannelVoiceMessages.NOTE_ON)
+NOTE_OFF = int(ChannelVoiceMessages.NOTE_OFF)
+
+
+class EventSchedule(NamedTuple):
+    """
+    All events of a MIDI file merged into one timeline. Every array has one
+    entry per event, ordered by time. Times are in samples.
+    """
+    time: NDArray[np.int64]
+    type: NDArray[np.int16]
+    channel: NDArray[np.int8]
+    pitch: NDArray[np.int16]
+    velocity: NDArray[np.int16]
+
+    @property
+    def duration(self) -> int:
+        return int(self.time[-1]) if len(self.time) > 0 else 0
+
+
+class TempoMap:
+    """
+    Converts positions in quarter lengths to samples. Tempo changes are
+    given as (offset in quarter lengths, quarter notes per minute). Before
+    the first change the tempo is 120 BPM, like in music21's MIDI export.
+    Every lookup is a binary search over the changes.
+    """
+    def __init__(self, changes: Iterable[Tuple[float, float]] = ()):
+        changes = sorted(changes, key=lambda change: change[0])
+        if len(changes) == 0 or changes[0][0] > 0:
+            changes = [(0.0, 120.0)] + changes
+        self.offsets = np.array([offset for offset, _ in changes], dtype=np.float64)
+        self.seconds_per_quarter = np.array([60.0 / bpm for _, bpm in changes], dtype=np.float64)
+        # Seconds at every tempo change
+        self.seconds = np.concatenate([[0.0], np.cumsum(np.diff(self.offsets) * self.seconds_per_quarter[:-1])])
+
+    def to_seconds(self, offsets: ArrayLike) -> NDArray[np.float64]:
+        offsets = np.asarray(offsets, dtype=np.float64)
+        i = np.searchsorted(self.offsets, offsets, side='right') - 1
+        return self.seconds[i] + (offsets - self.offsets[i]) * self.seconds_per_quarter[i]
+
+    def to_samples(self, offsets: ArrayLike, sample_rate: int = 44100) -> NDArray[np.int64]:
+        return np.round(self.to_seconds(offsets) * sample_rate).astype(np.int64)
+
+
+def _track_events(track, track_no: int):
+    track_tick = 0
+    for event_no, event in enumerate(track.events):
+        if isinstance(event, DeltaTime):
+            track_tick += event.time
+        else:
+            yield track_tick, track_no, event_no, event
+
+
+def compile_schedule(midi_data: MidiFile, sample_rate: int = 44100, channel: Optional[int] = 0) -> EventSchedule:
+    """
+    Merges the events of all tracks of midi_data into one EventSchedule.
+    The tracks are combined with a single k-way merge (heap), events with the
+    same time keep the order of their tracks. Ticks are converted to samples
+    with the SET_TEMPO events of the file. All events are moved to channel,
+    with channel=None they keep the channels of the file.
+    """
+    merged = heapq.merge(*[_track_events(track, track_no)
+                           for track_no, track in enumerate(midi_data.tracks)],
+                         key=lambda item: item[:3])
+    ticks, types, channels, pitches, velocities = [], [], [], [], []
+    tempo_changes = []
+    for event_tick, _, _, event in merged:
+        if event.type == MetaEvents.SET_TEMPO:
+            tempo_changes.append((event_tick / midi_data.ticksPerQuarterNote,
+                                  60_000_000 / int.from_bytes(event.data, 'big')))
+        ticks.append(event_tick)
+        types.append(int(event.type) if event.type is not None else -1)
+        channels.append(max((event.channel or 1) - 1, 0) if channel is None else channel)
+        pitches.append(event.pitch or 0)
+        velocities.append(event.velocity or 0)
+    quarters = np.array(ticks, dtype=np.float64) / midi_data.ticksPerQuarterNote
+    return EventSchedule(time=TempoMap(tempo_changes).to_samples(quarters, sample_rate),
+                         type=np.array(types, dtype=np.int16),
+                         channel=np.array(channels, dtype=np.int8),
+                         pitch=np.array(pitches, dtype=np.int16),
+                         velocity=np.array(velocities, dtype=np.int16))
+
+
+def stream_tempo_map(melody: Stream) -> TempoMap:
+    flat = melody.flatten()
+    return TempoMap([(float(flat.elementOffset(mark)), mark.getQuarterBPM())
+                     for mark in flat.getElementsByClass(MetronomeMark)])
+
+
+def compile_stream(melody: Stream, sample_rate: int = 44100, channel: int = 0,
+                   tempo_map: Optional[TempoMap] = None) -> EventSchedule:
+    """
+    Builds the EventSchedule of a music21 Stream directly, without creating
+    a MidiFile. Note offsets are converted to samples with a TempoMap of
+    the MetronomeMarks in the stream unless tempo_map is given.
+    """
+    with span("compile_stream"):
+        return _compile_stream(melody, sample_rate, channel, tempo_map)
+
+
+def _compile_stream(melody: Stream, sample_rate: int, channel: int, tempo_map: Optional[TempoMap]) -> EventSchedule:
+    flat = melody.flatten()
+    if any(n.tie is not None for n in flat.notes):
+        flat = flat.stripTies()
+    if tempo_map is None:
+        tempo_map = stream_tempo_map(flat)
+    offsets, pitches, velocities, is_on = [], [], [], []
+    for n in flat.notes:
+        length = float(n.quarterLength)
+        if length <= 0 or not hasattr(n, 'pitches'):
+            continue
+        onset = float(flat.elementOffset(n))
+        # Like music21's MIDI translation: velocity scaled by the Dynamics in context, 90 by default
+        velocity = round(n.volume.getRealized() * 127)
+        for p in n.pitches:
+            offsets += [onset, onset + length]
+            pitches += [p.midi, p.midi]
+            velocities += [velocity, 0]
+            is_on += [1, 0]
+    times = tempo_map.to_samples(offsets, sample_rate)
+    is_on = np.array(is_on, dtype=np.int16)
+    # Note offs come first, so a note repeated right away is struck again
+    order = np.lexsort((is_on, times))
+    return EventSchedule(time=times[order],
+                         type=np.where(is_on == 1, NOTE_ON, NOTE_OFF).astype(np.int16)[order],
+                         channel=np.full(len(order), channel, dtype=np.int8),
+                         pitch=np.array(pitches, dtype=np.int16)[order],
+                         velocity=np.array(velocities, dtype=np.int16)[order])
+
+
+def merge_schedules(schedules: Sequence[EventSchedule]) -> EventSchedule:
+    merged = EventSchedule(*[np.concatenate(arrays) for arrays in zip(*schedules)])
+    order = np.lexsort((merged.type == NOTE_ON, merged.time))
+    return EventSchedule(*[array[order] for array in merged])
+
+
+# MIDI channel 10 (9 when counting from 0) is reserved for percussion
+PART_CHANNELS = [c for c in range(16) if c != 9]
+
+
+def compile_score(score: Stream, sample_rate: int = 44100) -> Tuple[EventSchedule, List[int], List[int]]:
+    """
+    Compiles every Part of score to its own MIDI channel in one schedule.
+    The tempo of all parts follows the MetronomeMarks of the whole score.
+
+    Returns:
+    - The schedule, the channel and the MIDI program of every part.
+    """
+    parts = list(score.parts) if len(score.parts) > 0 else [score]
+    if len(parts) > len(PART_CHANNELS):
+        raise ValueError(f"A score can have at most {len(PART_CHANNELS)} parts, not {len(parts)}.")
+    tempo_map = stream_tempo_map(score)
+    channels = PART_CHANNELS[:len(parts)]
+    programs = []
+    for part in parts:
+        instrument = part.getInstrument(returnDefault=False)
+        programs.append(instrument.midiProgram if instrument is not None and instrument.midiProgram is not None
+                        else 0)
+    schedule = merge_schedules([compile_stream(part, sample_rate, channel, tempo_map)
+                                for part, channel in zip(parts, channels)])
+    return schedule, channels, programs
+
+
+def schedule_bytes(schedule: EventSchedule) -> bytes:
+    """The content of a schedule, e.g. for RenderCache keys."""
+    return b"".join(array.tobytes() for array in schedule)
+
+
+def render_schedule(schedule: EventSchedule, synth: fluidsynth.Synth,
+                    sample_rate: int = 44100, max_frames: int = 4096,
+                    write: Optional[Callable[[int], NDArray]] = None) -> Iterator[NDArray]:
+    """
+    Plays the schedule on synth and yields the rendered stereo samples
+    (interleaved) in pieces of at most max_frames frames. The synth has to
+    have the programs of all channels selected already. get_samples (or
+    write, if given) is only called between distinct timestamps.
+    """
+    if write is None:
+        write = synth.get_samples
+    write = timed("synthesize", write)
+
+    def consume(frames: int) -> Iterator[NDArray]:
+        count("samples_synthesized", frames)
+        while frames > 0:
+            n = min(frames, max_frames)
+            yield write(n)
+            frames -= n
+
+    channels = np.unique(schedule.channel).tolist() if len(schedule.channel) > 0 else [0]
+    count("events_dispatched", len(schedule.time))
+    progressing_time = 0  # Overall time across all tracks
+    try:
+        for event_time, event_type, channel, pitch, velocity in zip(
+                schedule.time.tolist(), schedule.type.tolist(), schedule.channel.tolist(),
+                schedule.pitch.tolist(), schedule.velocity.tolist()):
+            if event_time > progressing_time:
+                yield from consume(event_time - progressing_time)
+                progressing_time = event_time
+            if event_type == NOTE_ON:
+                synth.noteon(channel, pitch, velocity)
+            elif event_type == NOTE_OFF:
+                synth.noteoff(channel, pitch)
+        for channel in channels:
+            synth.all_notes_off(chan=channel)
+        yield from consume(int(sample_rate / 2))
+    finally:
+        for channel in channels:
+            synth.all_sounds_off(chan=channel)
+
+
+def waveform_size(schedule: EventSchedule, sample_rate: int = 44100) -> int:
+    """
+    Number of float32 values render_into writes for the schedule. Stereo
+    output is interleaved, so every frame takes two values.
+    """
+    return (schedule.duration + int(sample_rate / 2)) * 2
+
+
+def render_into(schedule: EventSchedule, synth: fluidsynth.Synth, out: NDArray[np.float32],
+                sample_rate: int = 44100) -> NDArray[np.float32]:
+    """
+    Renders the schedule directly into out, which needs at least
+    waveform_size(schedule, sample_rate) values. Returns the written part of out.
+    """
+    pos = 0
+    with span("render"):
+        for samples in render_schedule(schedule, synth, sample_rate, max_frames=len(out) // 2):
+            out[pos:pos + len(samples)] = samples
+            pos += len(samples)
+    return out[:pos]
+
+
+def part_to_waveform(melody: Stream, synth: fluidsynth.Synth, soundfont_filename: str, sample_rate: int = 44100,
+                     sfid: Optional[int] = None, cache: Optional[RenderCache] = None):
     """
     Converts a music21 Part object into a waveform represented as a numpy array.
 
+    The length of the piece is computed before synthesis starts, so the samples
+    are written straight into one preallocated float32 buffer.
+
     Parameters:
     - melody: music21.stream.Stream object containing the melody.
     - synth: fluidsynth.Synth object.
     - soundfont_filename: path of a soundfont in .sf2 format.
     - sample_rate: Sampling rate (default is 44100 Hz).
+    - sfid: id of the soundfont if it is already loaded in synth (e.g. from a SynthPool).
+    - cache: RenderCache to look up the waveform before rendering it.
 
     Returns:
     - A numpy array representing the waveform of the melody.
     """
-    # Convert the Part object to MIDI data
-    midi_data = streamToMidiFile(melody)
+    schedule = compile_stream(melody, sample_rate)
 
-    # Prepare counters for each track
-    counters = np.array([0] * len(midi_data.tracks), dtype=int)
-    current_time = np.array([0] * len(midi_data.tracks), dtype=int)  # Keep track of the current time in each track
-    progressing_time = 0  # Overall time across all tracks
+    def render() -> NDArray[np.float32]:
+        nonlocal sfid
+        if sfid is None:
+            with span("sfload"):
+                sfid = synth.sfload(soundfont_filename)
+        synth.program_select(0, sfid, 0, 0)
+        return render_into(schedule, synth, np.empty(waveform_size(schedule, sample_rate), dtype=np.float32),
+                           sample_rate)
 
-    # Buffer for the waveform data
-    waveform = np.array([], dtype=np.float32)
-
-    def next_event():
-        current_track = np.argmin(current_time)
-        if counters[current_track] >= len(midi_data.tracks[current_track].events):
-            found_another_track = False
-            for track_skip in range(1, len(midi_data.tracks)):
-                i = current_track + track_skip % len(midi_data.tracks)
-                if counters[i] >= len(midi_data.tracks[i].events):
-                    continue
-                else:
-                    current_track = i
-                    found_another_track = True
-                    break
-            if not found_another_track:
-                return None, None
-        focused_event = midi_data.tracks[current_track].events[counters[current_track]]
-        counters[current_track] += 1
-        if isinstance(focused_event, DeltaTime):
-            time_progression = int((focused_event.time / (10080 * 2)) * sample_rate)
-            current_time[current_track] += time_progression
-            return next_event()
-        else:
-            return focused_event, current_time[current_track]
+    if cache is None:
+        return render()
+    key = render_key(schedule_bytes(schedule), soundfont_filename, sample_rate, synth.get_setting('synth.gain'))
+    return cache.get_or_render(key, render)
+
+
+def waveform_blocks(melody: Stream, synth: fluidsynth.Synth, soundfont_filename: str,
+                    sample_rate: int = 44100, block_size: int = 4096,
+                    sfid: Optional[int] = None) -> Iterator[NDArray[np.float32]]:
+    """
+    Same as part_to_waveform but yields the waveform in blocks of block_size
+    frames while it is synthesized. Only the last block may be shorter.
+    The whole piece is never held in memory.
+
+    Parameters:
+    - melody: music21.stream.Stream object containing the melody.
+    - synth: fluidsynth.Synth object.
+    - soundfont_filename: path of a soundfont in .sf2 format.
+    - sample_rate: Sampling rate (default is 44100 Hz).
+    - block_size: Number of stereo frames per block.
+    - sfid: id of the soundfont if it is already loaded in synth (e.g. from a SynthPool).
 
-    sfid = synth.sfload(soundfont_filename)
+    Returns:
+    - An iterator over float32 numpy arrays with block_size * 2 interleaved values.
+    """
+    schedule = compile_stream(melody, sample_rate)
+    block = np.empty(block_size * 2, dtype=np.float32)
+    filled = 0
+    if sfid is None:
+        with span("sfload"):
+            sfid = synth.sfload(soundfont_filename)
     synth.program_select(0, sfid, 0, 0)
-    while True:
-        event, new_time = next_event()
-        if event is None:
-            break
-        consume_time = new_time - progressing_time
-        if consume_time > 0:
-            samples = synth.get_samples(int(consume_time))
-            waveform = np.append(waveform, samples)
-            progressing_time = new_time
-        if event.type == ChannelVoiceMessages.NOTE_ON:
-            #print(f"Note {event.pitch} on with {event.velocity}!")
-            synth.noteon(0, event.pitch, event.velocity)
-        elif event.type == ChannelVoiceMessages.NOTE_OFF:
-            #print(f"Note {event.pitch} off ...")
-            synth.noteoff(0, event.pitch)
-        else:
-            pass
-            #print("Doing nothing for", event)
-    synth.all_notes_off(chan=0)
-    samples = synth.get_samples(int(sample_rate / 2))
-    waveform = np.append(waveform, samples)
-    synth.all_sounds_off(chan=0)
-    return waveform
+    for samples in render_schedule(schedule, synth, sample_rate, max_frames=block_size):
+        pos = 0
+        while pos < len(samples):
+            n = min(len(samples) - pos, len(block) - filled)
+            block[filled:filled + n] = samples[pos:pos + n]
+            filled += n
+            pos += n
+            if filled == len(block):
+                yield block.copy()
+                filled = 0
+    if filled > 0:
+        yield block[:filled].copy()
+
+
+_nwrite_float = fluidsynth.cfunc('fluid_synth_nwrite_float', c_int,
+                                 ('synth', c_void_p, 1),
+                                 ('len', c_int, 1),
+                                 ('left', POINTER(POINTER(c_float)), 1),
+                                 ('right', POINTER(POINTER(c_float)), 1),
+                                 ('fx_left', POINTER(POINTER(c_float)), 1),
+                                 ('fx_right', POINTER(POINTER(c_float)), 1))
+
+
+class _PlanarWriter:
+    """Calls fluid_synth_nwrite_float into preallocated planar buffers, one stereo pair per audio group."""
+    def __init__(self, synth: fluidsynth.Synth, groups: int, max_frames: int):
+        if _nwrite_float is None:
+            raise RuntimeError("The installed libfluidsynth has no fluid_synth_nwrite_float.")
+        self.synth = synth
+        fx_channels = synth.get_setting('synth.effects-channels') * synth.get_setting('synth.effects-groups')
+        self.left = np.zeros((groups, max_frames), dtype=np.float32)
+        self.right = np.zeros((groups, max_frames), dtype=np.float32)
+        self.fx_left = np.zeros((fx_channels, max_frames), dtype=np.float32)
+        self.fx_right = np.zeros((fx_channels, max_frames), dtype=np.float32)
+        self.pointers = [(POINTER(c_float) * len(buffers))(*[b.ctypes.data_as(POINTER(c_float)) for b in buffers])
+                         for buffers in (self.left, self.right, self.fx_left, self.fx_right)]
+
+    def __call__(self, frames: int) -> NDArray[np.float32]:
+        """Returns the groups and the effects summed up as (groups + 1, frames, 2)."""
+        for buffers in (self.left, self.right, self.fx_left, self.fx_right):
+            buffers[:, :frames] = 0
+        _nwrite_float(self.synth.synth, frames, *self.pointers)
+        block = np.empty((len(self.left) + 1, frames, 2), dtype=np.float32)
+        block[:-1, :, 0] = self.left[:, :frames]
+        block[:-1, :, 1] = self.right[:, :frames]
+        block[-1, :, 0] = self.fx_left[:, :frames].sum(axis=0)
+        block[-1, :, 1] = self.fx_right[:, :frames].sum(axis=0)
+        return block
+
+
+def render_parts(score: Stream, synth: fluidsynth.Synth, soundfonts: Union[str, Sequence[str]],
+                 sample_rate: int = 44100, stems: bool = False,
+                 sfids: Optional[Dict[str, int]] = None
+                 ) -> Union[NDArray[np.float32], Tuple[NDArray[np.float32], NDArray[np.float32]]]:
+    """
+    Renders all parts of a score in one pass. Every part plays on its own
+    MIDI channel with the program of its instrument, from its own soundfont.
+
+    Parameters:
+    - score: music21 Score (or any Stream, which counts as one part).
+    - synth: synth from create_multichannel_fluidsynth. For stems it needs
+      at least as many audio groups as the highest part channel + 1. With
+      more than one audio group the mix is summed from all groups.
+    - soundfonts: one soundfont for all parts or one per part.
+    - sample_rate: Sampling rate (default is 44100 Hz).
+    - stems: Also return the stems of the parts from the same pass.
+    - sfids: soundfonts already loaded in synth, loaded fonts get added to it.
+
+    Returns:
+    - The mix like part_to_waveform returns it (interleaved stereo in the
+      range of int16) and with stems also an array (parts, frames * 2) of
+      the stems in the same format. The stems are dry, the reverb and chorus
+      of all parts only appear in the mix.
+    """
+    schedule, channels, programs = compile_score(score, sample_rate)
+    if isinstance(soundfonts, str):
+        soundfonts = [soundfonts] * len(channels)
+    if len(soundfonts) != len(channels):
+        raise ValueError(f"Got {len(soundfonts)} soundfonts for {len(channels)} parts.")
+    sfids = sfids if sfids is not None else {}
+    for channel, program, soundfont_filename in zip(channels, programs, soundfonts):
+        if soundfont_filename not in sfids:
+            with span("sfload"):
+                sfids[soundfont_filename] = synth.sfload(soundfont_filename)
+        synth.program_select(channel, sfids[soundfont_filename], 0, program)
+    groups = synth.get_setting('synth.audio-groups')
+    if not stems and groups == 1:
+        return render_into(schedule, synth, np.empty(waveform_size(schedule, sample_rate), dtype=np.float32),
+                           sample_rate)
+    # get_samples only returns audio group 0, so with more groups the mix is summed from all of them
+    if stems and groups <= max(channels):
+        raise ValueError(f"The synth needs {max(channels) + 1} audio groups for stems, it has {groups}.")
+    frames = waveform_size(schedule, sample_rate) // 2
+    planar = np.empty((groups + 1, frames, 2), dtype=np.float32)
+    pos = 0
+    with span("render"):
+        for block in render_schedule(schedule, synth, sample_rate, max_frames=4096,
+                                     write=_PlanarWriter(synth, groups, 4096)):
+            planar[:, pos:pos + block.shape[1]] = block
+            pos += block.shape[1]
+    planar = planar[:, :pos]
+    # Scale like get_samples (int16 range) and interleave
+    mix = planar.sum(axis=0).reshape(-1) * np.float32(32768)
+    if not stems:
+        return mix
+    return mix, planar[channels].reshape(len(channels), -1) * np.float32(32768)
+
+
+_worker_synth: Optional[fluidsynth.Synth] = None
+_worker_sfid: Optional[int] = None
+
+
+def _init_render_worker(soundfont_filename: str, sample_rate: int):
+    global _worker_synth, _worker_sfid
+    _worker_synth = create_fluidsynth(sample_rate=sample_rate, start=False)
+    _worker_sfid = _worker_synth.sfload(soundfont_filename)
+
+
+def _render_in_worker(index: int, melody: Stream, sample_rate: int) -> Tuple[int, str, int]:
+    schedule = compile_stream(melody, sample_rate)
+    size = waveform_size(schedule, sample_rate)
+    shm = SharedMemory(create=True, size=max(size, 1) * np.dtype(np.float32).itemsize)
+    try:
+        _worker_synth.program_select(0, _worker_sfid, 0, 0)
+        written = len(render_into(schedule, _worker_synth, np.ndarray(size, dtype=np.float32, buffer=shm.buf),
+                                  sample_rate))
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    # The parent unlinks the segment, so the resource tracker must not count it as leaked by this worker
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return index, shm.name, written
+
+
+def _take_from_shared_memory(name: str, size: int) -> NDArray[np.float32]:
+    shm = SharedMemory(name=name)
+    try:
+        return np.ndarray(size, dtype=np.float32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def render_many(streams: Iterable[Stream], soundfont_filename: str, workers: Optional[int] = None,
+                sample_rate: int = 44100, ordered: bool = True) -> Iterator[Tuple[int, NDArray[np.float32]]]:
+    """
+    Renders many streams in a pool of processes. Every worker creates its own
+    synth with the soundfont loaded once. The workers write the waveforms into
+    shared memory, so the audio is not pickled on the way back.
+
+    Parameters:
+    - streams: music21.stream.Stream objects to render.
+    - soundfont_filename: path of a soundfont in .sf2 format.
+    - workers: Number of processes (default is the number of CPUs).
+    - sample_rate: Sampling rate (default is 44100 Hz).
+    - ordered: Yield results in input order. Otherwise they are yielded as they complete.
+
+    Returns:
+    - An iterator over (index of the stream, waveform) tuples.
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                             initargs=(soundfont_filename, sample_rate)) as executor:
+        futures = [executor.submit(_render_in_worker, index, melody, sample_rate)
+                   for index, melody in enumerate(streams)]
+        collected = set()
+        try:
+            for future in (futures if ordered else as_completed(futures)):
+                index, name, size = future.result()
+                collected.add(index)
+                yield index, _take_from_shared_memory(name, size)
+        finally:
+            # Free the shared memory of results nobody is going to collect
+            for index, future in enumerate(futures):
+                if index not in collected and not future.cancel() and future.exception() is None:
+                    _take_from_shared_memory(*future.result()[1:])
 
 
 if __name__ == "__main__":
-    pa = pyaudio.PyAudio()
+    from itertools import chain
+    from realtime import RealtimeEngine, IteratorSource, PyAudioSink, interleaved_to_frames
 
     # Initial silence is 1 second
-    s = np.zeros(44100 * 1, dtype=np.float32)
+    s = np.zeros((44100 * 1, 2), dtype=np.float32)
 
     strm = Stream([MetronomeMark(number=120, referent=Note(type='quarter')),
                    TimeSignature('4/4'),
@@ -107,17 +535,12 @@ if __name__ == "__main__":
                    Note('G4', quarterLength=1),
                    Note('C4', quarterLength=1)])
 
-    fl = create_fluidsynth()
-    s = np.append(s, part_to_waveform(strm, synth=fl,
-                                      soundfont_filename="soundfonts/organ/Aggorg.sf2",
-                                      sample_rate=44100))
-    fl.delete()
-    print(f"Created a numpy array with shape {s.shape} of type {s.dtype} with values in the range {np.min(s)} to {np.max(s)}.")
-    samps = fluidsynth.raw_audio_string(s)
+    fl = create_fluidsynth(start=False)  # The RealtimeEngine plays the blocks
+    blocks = waveform_blocks(strm, synth=fl, soundfont_filename="soundfonts/organ/Aggorg.sf2",
+                             sample_rate=44100, block_size=1024)
     print('Starting playback')
-    pa_strm = pa.open(
-        format=pyaudio.paInt16,
-        channels=2,
-        rate=44100,
-        output=True)
-    pa_strm.write(samps)
+    engine = RealtimeEngine(IteratorSource(chain([s], (interleaved_to_frames(b) for b in blocks))), PyAudioSink())
+    engine.start()
+    engine.wait()
+    print(f"Played {engine.frames_played} frames with {engine.xruns} xruns.")
+    fl.delete()
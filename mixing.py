@@ -0,0 +1,197 @@
+import numpy as np
+from typing import Optional, Sequence, Tuple
+from numpy.typing import NDArray
+
+# Stems are float32 arrays (batch, stems, 2, frames) in the range [-1, 1],
+# mixes are (batch, 2, frames). Every function works in place or writes
+# into out, so mixing a batch allocates nothing of the size of the audio.
+
+
+def load_stems_into(waveforms: Sequence[NDArray[np.float32]], out: NDArray[np.float32]) -> NDArray[np.float32]:
+    """
+    Copies waveforms as part_to_waveform renders them (interleaved stereo in
+    the range of int16) into out with the shape (stems, 2, frames), scaled to
+    [-1, 1]. Stems shorter than out get padded with silence.
+    """
+    for stem, waveform in zip(out, waveforms):
+        frames = min(len(waveform) // 2, stem.shape[1])
+        np.multiply(waveform[:frames * 2].reshape(-1, 2).T, np.float32(1 / 32768), out=stem[:, :frames])
+        stem[:, frames:] = 0
+    return out
+
+
+def stereo_gains(gains: NDArray, pan: Optional[NDArray] = None) -> NDArray[np.float32]:
+    """
+    Combines linear gains (batch, stems) with pan positions from -1 (left) to
+    1 (right) into gains (batch, stems, 2) for both channels. Panning keeps
+    the power of a centered stem constant.
+    """
+    gains = np.asarray(gains, dtype=np.float32)
+    result = np.repeat(gains[..., np.newaxis], 2, axis=-1)
+    if pan is not None:
+        angle = (np.asarray(pan, dtype=np.float32) + 1) * np.float32(np.pi / 4)
+        result[..., 0] *= np.float32(np.sqrt(2)) * np.cos(angle)
+        result[..., 1] *= np.float32(np.sqrt(2)) * np.sin(angle)
+    return result
+
+
+def apply_gains(stems: NDArray[np.float32], gains: NDArray,
+                out: Optional[NDArray[np.float32]] = None) -> NDArray[np.float32]:
+    """
+    Multiplies stems with gains of the shape (batch, stems) or per channel
+    (batch, stems, 2) from stereo_gains.
+    """
+    gains = np.asarray(gains, dtype=np.float32)
+    if gains.ndim == stems.ndim - 2:
+        gains = gains[..., np.newaxis]
+    return np.multiply(stems, gains[..., np.newaxis], out=stems if out is None else out)
+
+
+def _shift_into(stems: NDArray[np.float32], out: NDArray[np.float32], index: tuple, offset: int):
+    frames = stems.shape[-1]
+    if offset == 0:
+        out[index] = stems[index]
+    elif offset > 0:
+        out[index + (Ellipsis, slice(offset, None))] = stems[index + (Ellipsis, slice(None, max(frames - offset, 0)))]
+        out[index + (Ellipsis, slice(None, offset))] = 0
+    else:
+        out[index + (Ellipsis, slice(None, max(frames + offset, 0)))] = stems[index + (Ellipsis, slice(-offset, None))]
+        out[index + (Ellipsis, slice(max(frames + offset, 0), None))] = 0
+
+
+def shift(stems: NDArray[np.float32], offsets: NDArray,
+          out: Optional[NDArray[np.float32]] = None, chunk_bytes: int = 256 * 1024,
+          min_group: int = 4) -> NDArray[np.float32]:
+    """
+    Delays every stem by offsets (batch, stems) frames, or advances it for
+    negative offsets, and fills the gap with silence. At least min_group
+    stems with the same offset move together in fancy-indexed chunks of
+    about chunk_bytes, so the temporary copy numpy makes of them stays in
+    the cache. The other stems are copied one by one in memory order, a
+    slice of one stem is faster than a fancy index of a few.
+    """
+    in_place = out is None or out is stems
+    if out is None:
+        out = stems
+    offsets = np.asarray(offsets)
+    values, inverse, counts = np.unique(offsets.ravel(), return_inverse=True, return_counts=True)
+    grouped = counts >= min_group
+    chunk_stems = max(chunk_bytes // max(stems[(0,) * offsets.ndim].nbytes, 1), 1) if offsets.size > 0 else 1
+    for value in np.flatnonzero(grouped).tolist():
+        offset = int(values[value])
+        if offset == 0 and in_place:
+            continue
+        group = np.unravel_index(np.flatnonzero(inverse == value), offsets.shape)
+        for start in range(0, len(group[0]), chunk_stems):
+            _shift_into(stems, out, tuple(i[start:start + chunk_stems] for i in group), offset)
+    single = np.flatnonzero(~grouped[inverse] & ((offsets.ravel() != 0) | (not in_place)))
+    indices = zip(*[i.tolist() for i in np.unravel_index(single, offsets.shape)])
+    for index, offset in zip(indices, offsets.ravel()[single].tolist()):
+        _shift_into(stems, out, index, offset)
+    return out
+
+
+def mix(stems: NDArray[np.float32], out: Optional[NDArray[np.float32]] = None) -> NDArray[np.float32]:
+    """Sums the stems (batch, stems, 2, frames) to mixes (batch, 2, frames)."""
+    return np.sum(stems, axis=-3, out=out)
+
+
+def peaks(signals: NDArray[np.float32], axes: int = 2) -> NDArray[np.float32]:
+    """The absolute peak of signals over the last axes axes, without a copy for abs."""
+    axis = tuple(range(-axes, 0))
+    return np.maximum(signals.max(axis=axis), -signals.min(axis=axis))
+
+
+def normalize(mixes: NDArray[np.float32], stems: Optional[NDArray[np.float32]] = None,
+              peak: float = 1.0, amplify: bool = False) -> NDArray[np.float32]:
+    """
+    Scales every mix to peak when it is louder (or, with amplify, quieter)
+    and its stems by the same factor, so the mix stays the sum of its stems.
+
+    Returns:
+    - The factors (batch,) the examples were scaled with.
+    """
+    mix_peaks = peaks(mixes)
+    scale = np.ones_like(mix_peaks)
+    change = mix_peaks > 0 if amplify else mix_peaks > peak
+    scale[change] = np.float32(peak) / mix_peaks[change]
+    mixes *= scale[:, np.newaxis, np.newaxis]
+    if stems is not None:
+        stems *= scale[:, np.newaxis, np.newaxis, np.newaxis]
+    return scale
+
+
+def clip(signals: NDArray[np.float32], limit: float = 1.0,
+         out: Optional[NDArray[np.float32]] = None) -> NDArray[np.float32]:
+    return np.clip(signals, -limit, limit, out=signals if out is None else out)
+
+
+def to_int16(signals: NDArray[np.float32], out: Optional[NDArray[np.int16]] = None,
+             interleaved: bool = True, block_frames: int = 8192) -> NDArray[np.int16]:
+    """
+    Converts signals (..., 2, frames) in [-1, 1] to int16, clipping values
+    outside. interleaved gives (..., frames, 2), e.g. for out.tobytes() as a
+    PyAudio buffer. The conversion runs in blocks of block_frames frames, so
+    the only float copy is one block.
+    """
+    frames = signals.shape[-1]
+    if out is None:
+        out = np.empty(signals.shape[:-2] + (frames, signals.shape[-2]) if interleaved else signals.shape,
+                       dtype=np.int16)
+    target = out.swapaxes(-1, -2) if interleaved else out
+    block = np.empty(signals.shape[:-1] + (min(frames, block_frames),), dtype=np.float32)
+    for start in range(0, frames, block_frames):
+        part = signals[..., start:start + block_frames]
+        scaled = block[..., :part.shape[-1]]
+        np.multiply(part, np.float32(32767), out=scaled)
+        np.clip(scaled, -32767, 32767, out=scaled)
+        np.rint(scaled, out=scaled)
+        target[..., start:start + block_frames] = scaled
+    return out
+
+
+def random_mix_parameters(rng: np.random.Generator, batch: int, stems: int,
+                          gain_db: Tuple[float, float] = (-6.0, 0.0), max_pan: float = 0.5,
+                          max_shift: int = 0) -> Tuple[NDArray[np.float32], NDArray[np.int64]]:
+    """
+    Returns:
+    - Gains (batch, stems, 2) for apply_gains and offsets (batch, stems) for shift.
+    """
+    gains = 10 ** (rng.uniform(gain_db[0], gain_db[1], (batch, stems)) / 20)
+    pan = rng.uniform(-max_pan, max_pan, (batch, stems))
+    offsets = rng.integers(-max_shift, max_shift + 1, (batch, stems))
+    return stereo_gains(gains, pan), offsets
+
+
+def augment(stems: NDArray[np.float32], rng: np.random.Generator,
+            mix_out: Optional[NDArray[np.float32]] = None,
+            gain_db: Tuple[float, float] = (-6.0, 0.0), max_pan: float = 0.5, max_shift: int = 0,
+            peak: float = 1.0) -> NDArray[np.float32]:
+    """
+    Applies random gains, panning and time shifts to stems in place, mixes
+    them into mix_out and scales mixes louder than peak together with their stems.
+
+    Returns:
+    - The mixes (batch, 2, frames).
+    """
+    gains, offsets = random_mix_parameters(rng, stems.shape[0], stems.shape[1], gain_db, max_pan, max_shift)
+    if max_shift > 0:
+        shift(stems, offsets)
+    apply_gains(stems, gains)
+    mix_out = mix(stems, mix_out)
+    normalize(mix_out, stems, peak)
+    return mix_out
+
+
+if __name__ == "__main__":
+    import time
+
+    generator = np.random.default_rng(0)
+    batch_stems = generator.uniform(-0.3, 0.3, (64, 4, 2, 44100 * 4)).astype(np.float32)
+    batch_mixes = np.empty((64, 2, 44100 * 4), dtype=np.float32)
+    pcm = np.empty((64, 44100 * 4, 2), dtype=np.int16)
+    start = time.perf_counter()
+    augment(batch_stems, generator, batch_mixes, max_shift=4410)
+    to_int16(batch_mixes, pcm)
+    print(f"Mixed {batch_stems.shape[0]} examples with {batch_stems.shape[1]} stems "
+          f"in {time.perf_counter() - start:.3f} s.")
@@ -1,14 +1,15 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Union
 import torch
 from torch.distributions import uniform
 from emotional_narrative import EmotionSequenceGenerator
+from instrumentation import count, span
 from typing import cast
 import os
 
 
 class MusicalModifier(object):
     def __init__(self, emo_vector: torch.Tensor = None):
-        if not emo_vector:
+        if emo_vector is None:
             esg = EmotionSequenceGenerator()
             self.emo_vector = torch.nn.Parameter(esg.generate_sequence(1).flatten())
         else:
@@ -106,62 +107,231 @@ class EffectChange(MusicalModifier):
         return "effect_change"
 
 
+CATEGORIES = ("chord_progression", "pitch_direction", "tempo_change", "instrument_cue", "key_change", "effect_change")
+
+
+class ModifierTable:
+    """
+    The attributes of a list of modifiers precomputed into tensors, so
+    filtering is a boolean mask and selection a masked softmax. All methods
+    accept arbitrary leading batch dimensions on the state tensors.
+    """
+    def __init__(self, modifiers: List[MusicalModifier]):
+        self.modifiers = modifiers
+        self.instrument_types = sorted({m.instrument_type for m in modifiers if type(m) is InstrumentCue})
+        self.category = torch.tensor([CATEGORIES.index(m.category) for m in modifiers])
+        self.is_key_change = torch.tensor([type(m) is KeyChange for m in modifiers])
+        self.new_key = torch.tensor([m.new_key if type(m) is KeyChange else 0 for m in modifiers])
+        self.is_cue = torch.tensor([type(m) is InstrumentCue for m in modifiers])
+        self.instrument = torch.tensor([self.instrument_types.index(m.instrument_type) if type(m) is InstrumentCue
+                                        else 0 for m in modifiers])
+        self.cue_on = torch.tensor([type(m) is InstrumentCue and m.on for m in modifiers])
+        self.cue_off = self.is_cue & ~self.cue_on
+        self.instrument_slots = max(len(self.instrument_types), 1)  # Keeps indexing valid without instruments
+        self.category_count = len(set(self.category.tolist()))
+        self.emo_matrix = torch.empty(0)
+        self.refresh()
+
+    def refresh(self):
+        """Restacks the emo_vectors. Call it after changing them."""
+        with torch.no_grad():
+            self.emo_matrix = torch.stack([m.emo_vector.detach() for m in self.modifiers])
+
+    def __len__(self) -> int:
+        return len(self.modifiers)
+
+    def check_modifiers_per_step(self, modifiers_per_step: int):
+        """Every modifier of a step needs its own category, so there can't be more than categories."""
+        if not 1 <= modifiers_per_step <= self.category_count:
+            raise ValueError(f"modifiers_per_step has to be between 1 and {self.category_count}, "
+                             f"not {modifiers_per_step}.")
+
+    def mask(self, used_categories: torch.Tensor, key: torch.Tensor, active: torch.Tensor) -> torch.Tensor:
+        """
+        Parameters:
+        - used_categories: bool tensor (..., len(CATEGORIES)) of the categories used in the current step.
+        - key: int tensor (...) with the current key.
+        - active: bool tensor (..., instrument_slots) of the playing instruments.
+
+        Returns:
+        - A bool tensor (..., len(modifiers)) of the modifiers which may be selected.
+        """
+        allowed = ~used_categories[..., self.category]
+        allowed &= ~(self.is_key_change & (self.new_key == key.unsqueeze(-1)))
+        instrument_active = active[..., self.instrument]
+        allowed &= ~(self.cue_off & ~instrument_active)
+        allowed &= ~(self.cue_on & instrument_active)
+        return allowed
+
+    def select(self, allowed: torch.Tensor, emotion_delta: torch.Tensor, randomness: torch.Tensor,
+               generator: Optional[torch.Generator] = None) -> torch.Tensor:
+        """
+        Samples one modifier index per batch entry from the allowed modifiers.
+        """
+        distances = torch.sqrt(torch.sum((self.emo_matrix - emotion_delta.unsqueeze(-2)) ** 2, dim=-1))
+        logits = (distances + randomness.unsqueeze(-1)).masked_fill(~allowed, float('-inf'))
+        probabilities = torch.softmax(logits, dim=-1)
+        selected = torch.multinomial(probabilities.reshape(-1, len(self)), 1, generator=generator)
+        return selected.reshape(allowed.shape[:-1])
+
+    def apply(self, selected: torch.Tensor, used_categories: torch.Tensor, key: torch.Tensor, active: torch.Tensor):
+        """Updates the state tensors in place with the selected modifiers."""
+        used_categories.scatter_(-1, self.category[selected].unsqueeze(-1), True)
+        key.copy_(torch.where(self.is_key_change[selected], self.new_key[selected], key))
+        instrument = self.instrument[selected].unsqueeze(-1)
+        toggled = torch.where(self.is_cue[selected], self.cue_on[selected],
+                              active.gather(-1, instrument).squeeze(-1))
+        active.scatter_(-1, instrument, toggled.unsqueeze(-1))
+
+
+def create_modifiers(instrument_types: Optional[List[str]] = None) -> List[MusicalModifier]:
+    """
+    All modifiers a composer can choose from. Without instrument_types every
+    directory in soundfonts/ is an instrument.
+    """
+    modifiers: List[MusicalModifier] = []
+    progressions = [
+        [1, 5, -4, 4]
+    ]
+    modifiers += [ChordProgression(p) for p in progressions]
+    modifiers += [PitchDirection(1.0), PitchDirection(-1.0)]
+    modifiers += [TempoChange(1.0), TempoChange(-1.0)]
+    if instrument_types is None:
+        instrument_types = os.listdir("soundfonts")
+    for instrument_type in instrument_types:
+        modifiers += [InstrumentCue(instrument_type, 1), InstrumentCue(instrument_type, 0)]
+    modifiers += [KeyChange(key_no) for key_no in range(-11, 12)]
+    modifiers.append(EffectChange({"reverb": +0.5}))
+    return modifiers
+
+
 class MovementComposer:
     def __init__(self,
                  emo_sequence: torch.Tensor, emo_sequence_offset: int = 0,
                  emo_state_init: torch.Tensor = torch.zeros(5),
-                 key_init: int = torch.randint(-11, 12, [1])):
+                 key_init: Optional[int] = None,
+                 instrument_types: Optional[List[str]] = None):
         self.emo_sequence = emo_sequence
         self.emo_seq_pos = emo_sequence_offset
         self.emo_state = emo_state_init
-        self.key = key_init
+        # A copy, because ModifierTable.apply changes the key in place
+        self.key = torch.as_tensor(key_init).clone().reshape(()) if key_init is not None else \
+            torch.randint(-11, 12, [])
         self.instrument_tracks: List[InstrumentCue] = []
         self.active_instrument_tracks: List[InstrumentCue] = []
-        self.modifiers: List[MusicalModifier] = []
-        progressions = [
-            [1, 5, -4, 4]
-        ]
-        self.modifiers += [ChordProgression(p) for p in progressions]
-        self.modifiers += [PitchDirection(1.0), PitchDirection(-1.0)]
-        self.modifiers += [TempoChange(1.0), TempoChange(-1.0)]
-        for instrument_type in os.listdir("soundfonts"):
-            self.modifiers += [InstrumentCue(instrument_type, 1), InstrumentCue(instrument_type, 0)]
-        self.modifiers += [KeyChange(key_no) for key_no in range(-11, 12)]
-        self.modifiers.append(EffectChange({"reverb": +0.5}))
+        self.modifiers: List[MusicalModifier] = create_modifiers(instrument_types)
+        self.table = ModifierTable(self.modifiers)
+        self.active = torch.zeros(self.table.instrument_slots, dtype=torch.bool)
+        self.used_categories = torch.zeros(len(CATEGORIES), dtype=torch.bool)
         self.composition: List[List[MusicalModifier]] = [[]]
 
-    def compose_movement(self) -> List[List[MusicalModifier]]:
-        next_emo = self.emo_sequence[self.emo_seq_pos]
-        emotion_delta = next_emo - self.emo_state
-        self.select_modifier(self.filter_modifiers(emotion_delta), emotion_delta, next_emo[4])
-        # add to composition
+    def compose_movement(self, modifiers_per_step: int = 1) -> List[List[MusicalModifier]]:
+        """
+        Steps through the rest of the emo_sequence. Every step gets a new
+        group of modifiers_per_step modifiers from different categories.
+        """
+        self.table.check_modifiers_per_step(modifiers_per_step)
+        with span("compose_movement"):
+            count("modifiers_selected", (len(self.emo_sequence) - self.emo_seq_pos) * modifiers_per_step)
+            while self.emo_seq_pos < len(self.emo_sequence):
+                next_emo = self.emo_sequence[self.emo_seq_pos]
+                emotion_delta = next_emo - self.emo_state
+                if len(self.composition[-1]) > 0:
+                    self.composition.append([])
+                    self.used_categories.zero_()
+                for _ in range(modifiers_per_step):
+                    self.select_modifier(self._mask(), emotion_delta, next_emo[4])
+                self.emo_state = next_emo
+                self.emo_seq_pos += 1
         return self.composition
 
+    def _mask(self) -> torch.Tensor:
+        return self.table.mask(self.used_categories, self.key, self.active)
+
     def filter_modifiers(self, emotion_delta: torch.Tensor) -> List[MusicalModifier]:
-        used_up_categories = set()
-        for modifier in self.composition[-1]:
-            used_up_categories.add(modifier.category)
-        filtered_modifiers = []
-        for modifier in self.modifiers:
-            if modifier.category in used_up_categories:
-                continue
-            if type(modifier) is KeyChange and cast(KeyChange, modifier).new_key == self.key:
-                continue
-            if type(modifier) is InstrumentCue:
-                inst_cue = cast(InstrumentCue, modifier)
-                if inst_cue.off and inst_cue not in self.active_instrument_tracks:
-                    continue
-            filtered_modifiers.append(modifier)
-        return filtered_modifiers
+        return [m for m, allowed in zip(self.modifiers, self._mask().tolist()) if allowed]
 
     def select_modifier(self,
-                        filtered_modifiers: List[MusicalModifier],
+                        allowed: Union[torch.Tensor, List[MusicalModifier]],
                         emotion_delta: torch.Tensor,
-                        randomness: torch.Tensor):
-        offered_emo_matrix = torch.stack([m.emo_vector for m in filtered_modifiers])
-        distances = torch.sqrt(torch.sum((offered_emo_matrix - emotion_delta) ** 2, dim=1))
-        modifier_id = torch.multinomial(torch.nn.Softmax().forward(distances + randomness), 1, replacement=False)
+                        randomness: torch.Tensor) -> MusicalModifier:
+        """
+        Selects one of the allowed modifiers, given as the bool mask of
+        _mask or as the list of filter_modifiers, and applies it.
+        """
+        if not isinstance(allowed, torch.Tensor):
+            allowed_ids = {id(m) for m in allowed}
+            allowed = torch.tensor([id(m) in allowed_ids for m in self.modifiers], dtype=torch.bool)
+        modifier_id = self.table.select(allowed, emotion_delta, randomness)
         # modifier_idx = torch.argmax(torch.dot(delta_emotion, modifier_vectors)).item()
+        self.table.apply(modifier_id, self.used_categories, self.key, self.active)
+        modifier = self.modifiers[int(modifier_id)]
+        if type(modifier) is InstrumentCue:
+            inst_cue = cast(InstrumentCue, modifier)
+            self.active_instrument_tracks = [m for m in self.active_instrument_tracks
+                                             if m.instrument_type != inst_cue.instrument_type]
+            if inst_cue.on:
+                self.active_instrument_tracks.append(inst_cue)
+        self.composition[-1].append(modifier)
+        return modifier
+
+
+class BatchedMovementComposer:
+    """
+    Composes a batch of movements at once. Key, playing instruments and
+    emotion state of every movement are tensors and every selection step
+    samples the modifiers for all movements with one tensor operation.
+
+    Parameters:
+    - emo_sequence: tensor (batch, seq_len, 5) of emotion sequences.
+    - emo_state_init: tensor (batch, 5) with the initial emotions (default zeros).
+    - key_init: int tensor (batch,) with the initial keys (default random).
+    - modifiers: the modifiers to choose from (default create_modifiers(instrument_types)).
+    """
+    def __init__(self,
+                 emo_sequence: torch.Tensor,
+                 emo_state_init: Optional[torch.Tensor] = None,
+                 key_init: Optional[torch.Tensor] = None,
+                 instrument_types: Optional[List[str]] = None,
+                 modifiers: Optional[List[MusicalModifier]] = None,
+                 generator: Optional[torch.Generator] = None):
+        batch = emo_sequence.shape[0]
+        self.emo_sequence = emo_sequence
+        self.generator = generator
+        self.emo_state = emo_state_init.clone() if emo_state_init is not None else torch.zeros(batch, 5)
+        self.key = key_init.clone() if key_init is not None else \
+            torch.randint(-11, 12, [batch], generator=generator)
+        self.modifiers = modifiers if modifiers is not None else create_modifiers(instrument_types)
+        self.table = ModifierTable(self.modifiers)
+        self.active = torch.zeros(batch, self.table.instrument_slots, dtype=torch.bool)
+        self.composition = torch.empty(batch, 0, 0, dtype=torch.long)
+
+    def compose_movements(self, modifiers_per_step: int = 1) -> torch.Tensor:
+        """
+        Returns:
+        - A tensor (batch, seq_len, modifiers_per_step) with indices into self.modifiers.
+        """
+        self.table.check_modifiers_per_step(modifiers_per_step)
+        batch, seq_len, _ = self.emo_sequence.shape
+        count("modifiers_selected", batch * seq_len * modifiers_per_step)
+        self.composition = torch.empty(batch, seq_len, modifiers_per_step, dtype=torch.long)
+        used_categories = torch.empty(batch, len(CATEGORIES), dtype=torch.bool)
+        with span("compose_movements"):
+            for step in range(seq_len):
+                next_emo = self.emo_sequence[:, step]
+                emotion_delta = next_emo - self.emo_state
+                used_categories.zero_()
+                for i in range(modifiers_per_step):
+                    allowed = self.table.mask(used_categories, self.key, self.active)
+                    selected = self.table.select(allowed, emotion_delta, next_emo[:, 4], self.generator)
+                    self.table.apply(selected, used_categories, self.key, self.active)
+                    self.composition[:, step, i] = selected
+                self.emo_state = next_emo
+        return self.composition
+
+    def movement(self, index: int) -> List[List[MusicalModifier]]:
+        """The composition of one movement in the format of MovementComposer."""
+        return [[self.modifiers[m] for m in step] for step in self.composition[index].tolist()]
 
 
 if __name__ == "__main__":
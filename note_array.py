@@ -0,0 +1,123 @@
+import numpy as np
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+from numpy.typing import NDArray, ArrayLike
+
+DEFAULT_VELOCITY = 90  # What music21 uses for notes without dynamics
+
+
+class NoteArray:
+    """
+    A score stored as a structure of arrays: every note has a MIDI pitch,
+    an onset and a duration in quarter lengths, a velocity and a MIDI channel
+    (0-based). Notes with the same onset and duration sound together as a
+    chord. Conversion to music21 only happens in to_stream/to_midi_file.
+    """
+    __slots__ = ('pitch', 'onset', 'duration', 'velocity', 'channel')
+
+    def __init__(self, pitch: ArrayLike, onset: ArrayLike, duration: ArrayLike,
+                 velocity: Optional[ArrayLike] = None, channel: Optional[ArrayLike] = None):
+        self.pitch: NDArray[np.int16] = np.asarray(pitch, dtype=np.int16)
+        self.onset: NDArray[np.float64] = np.asarray(onset, dtype=np.float64)
+        self.duration: NDArray[np.float64] = np.asarray(duration, dtype=np.float64)
+        self.velocity: NDArray[np.int16] = np.full(len(self.pitch), DEFAULT_VELOCITY, dtype=np.int16) \
+            if velocity is None else np.asarray(velocity, dtype=np.int16)
+        self.channel: NDArray[np.int8] = np.zeros(len(self.pitch), dtype=np.int8) \
+            if channel is None else np.asarray(channel, dtype=np.int8)
+
+    @classmethod
+    def from_chords(cls, chords: Iterable[Sequence[int]], durations: Iterable[float],
+                    start: float = 0.0) -> "NoteArray":
+        """
+        Builds a NoteArray from chords (tuples of MIDI pitches) played one
+        after another with the given durations.
+        """
+        pitches, onsets, lengths = [], [], []
+        onset = start
+        for chord, duration in zip(chords, durations):
+            pitches += chord
+            onsets += [onset] * len(chord)
+            lengths += [duration] * len(chord)
+            onset += duration
+        return cls(pitches, onsets, lengths)
+
+    @classmethod
+    def concatenate(cls, arrays: Sequence["NoteArray"]) -> "NoteArray":
+        return cls(*[np.concatenate([getattr(a, name) for a in arrays]) for name in cls.__slots__])
+
+    def __len__(self) -> int:
+        return len(self.pitch)
+
+    @property
+    def end(self) -> float:
+        return float(np.max(self.onset + self.duration)) if len(self) > 0 else 0.0
+
+    def transpose(self, semitones: int) -> "NoteArray":
+        return NoteArray(self.pitch + semitones, self.onset, self.duration, self.velocity, self.channel)
+
+    def chords(self) -> Iterator[Tuple[float, float, NDArray[np.int16], int, int]]:
+        """
+        Groups notes with the same onset, duration, velocity and channel.
+        Yields (onset, duration, pitches, velocity, channel) ordered by onset.
+        """
+        order = np.lexsort((self.pitch, self.channel, self.velocity, self.duration, self.onset))
+        keys = np.stack([self.onset[order], self.duration[order],
+                         self.velocity[order], self.channel[order]], axis=1)
+        boundaries = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+        for group in np.split(order, boundaries):
+            if len(group) == 0:
+                continue
+            first = group[0]
+            yield (float(self.onset[first]), float(self.duration[first]), self.pitch[group],
+                   int(self.velocity[first]), int(self.channel[first]))
+
+    def to_stream(self):
+        """
+        Converts the notes to a music21 Stream with a Note or Chord per group
+        of simultaneous notes. Notes on other channels than 0 give a Score
+        with one Part per channel instead, the channel is the midiChannel of
+        the Instrument of the Part.
+        """
+        from music21.chord import Chord
+        from music21.instrument import Instrument
+        from music21.note import Note
+        from music21.stream import Part, Score, Stream
+        channels = np.unique(self.channel)
+        if np.all(channels == 0):
+            parts = {0: Stream()}
+        else:
+            parts = {}
+            for channel in channels.tolist():
+                parts[channel] = Part()
+                instrument = Instrument()
+                instrument.midiChannel = channel
+                parts[channel].insert(0, instrument)
+        for onset, duration, pitches, velocity, channel in self.chords():
+            if len(pitches) == 1:
+                element = Note(int(pitches[0]), quarterLength=duration)
+            else:
+                element = Chord([int(p) for p in pitches], quarterLength=duration)
+            element.volume.velocity = velocity
+            parts[channel].insert(onset, element)
+        if len(parts) == 1 and 0 in parts:
+            return parts[0]
+        score = Score()
+        for part in parts.values():
+            score.insert(0, part)
+        return score
+
+    def to_midi_file(self):
+        """
+        A MidiFile of to_stream. Every Part keeps its channel, music21 would
+        put Parts without a distinct MIDI program on one channel.
+        """
+        from music21.midi.translate import streamToMidiFile
+        from music21.stream import Score
+        s = self.to_stream()
+        midi_file = streamToMidiFile(s)
+        parts = list(s.parts) if isinstance(s, Score) else []
+        for part, track in zip(parts, midi_file.tracks[len(midi_file.tracks) - len(parts):]):
+            channel = part.getInstrument(returnDefault=False).midiChannel
+            for event in track.events:
+                if event.channel is not None:
+                    event.channel = channel + 1  # MIDI files count channels from 1
+        return midi_file
@@ -1,12 +1,27 @@
+import random
+import numpy as np
+from numbers import Integral
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from numpy.typing import NDArray
 from music21.note import Note
 from music21.chord import Chord
 from music21.interval import Interval
 from music21.stream import Stream, Part
-from circle_of_fiths import CircleOfFifths, MajorMinor, major, minor
-from random import choice, randint
+from circle_of_fiths import CircleOfFifths, MajorMinor, major, minor, base_pitch, circle_index, chord_table, \
+    inversion_table
+from note_array import NoteArray
+from instrumentation import span
+from random import choice
 
 
-def transpose_to_octave(tone: Note, octave_no: int = 4) -> Note:
+def octave_of(pitch: int) -> int:
+    return pitch // 12 - 1
+
+
+def transpose_to_octave(tone: Union[Note, int], octave_no: int = 4) -> Union[Note, int]:
+    if isinstance(tone, Integral):
+        tone = int(tone)
+        return tone + 12 * (octave_no - octave_of(tone))
     while tone.octave > octave_no:
         tone = tone.transpose('P-8')
     while tone.octave < octave_no:
@@ -14,7 +29,10 @@ def transpose_to_octave(tone: Note, octave_no: int = 4) -> Note:
     return tone
 
 
-def transpose_chord_to_octave(chord: Chord, octave_no: int = 4) -> Chord:
+def transpose_chord_to_octave(chord: Union[Chord, Tuple[int, ...]], octave_no: int = 4) -> Union[Chord, Tuple[int, ...]]:
+    if not isinstance(chord, Chord):
+        shift = 12 * (octave_no - octave_of(int(min(chord))))
+        return tuple(int(p) + shift for p in chord)
     while get_lowest_note_of_chord(chord).octave > octave_no:
         chord = chord.transpose('P-8')
     while get_lowest_note_of_chord(chord).octave < octave_no:
@@ -22,7 +40,16 @@ def transpose_chord_to_octave(chord: Chord, octave_no: int = 4) -> Chord:
     return chord
 
 
-def build_chord(base_tone: Note, mode: MajorMinor = major, inversion=0):
+def build_chord(base_tone: Union[Note, int], mode: MajorMinor = major, inversion=0) -> Union[Chord, Tuple[int, ...]]:
+    if isinstance(base_tone, Integral):
+        base_tone = int(base_tone)
+        second_tone = base_tone + (4 if mode == major else 3)
+        third_tone = base_tone + 7
+        if inversion >= 1:
+            base_tone += 12
+        if inversion >= 2:
+            second_tone += 12
+        return base_tone, second_tone, third_tone
     intervals = ('M3', 'm3') if mode == major else ('m3', 'M3')
     second_tone = base_tone.transpose(intervals[0])
     third_tone = second_tone.transpose(intervals[1])
@@ -33,15 +60,22 @@ def build_chord(base_tone: Note, mode: MajorMinor = major, inversion=0):
     return Chord([base_tone, second_tone, third_tone])
 
 
-def build_chord_and_select_inversion(base_tone: Note, mode: MajorMinor, prev_base_tone: Note) -> Chord:
+def build_chord_and_select_inversion(base_tone: Union[Note, int], mode: MajorMinor,
+                                     prev_base_tone: Union[Note, int]) -> Union[Chord, Tuple[int, ...]]:
+    if isinstance(base_tone, Integral):
+        index = circle_index(int(base_tone))
+        inversion = inversion_table()[mode.value, index, int(prev_base_tone)]
+        return tuple(int(p) for p in chord_table()[mode.value, index, inversion])
     chord = transpose_chord_to_octave(build_chord(base_tone, mode, inversion=0))
     chord6 = transpose_chord_to_octave(build_chord(base_tone, mode, inversion=1))
     chordq6 = transpose_chord_to_octave(build_chord(base_tone, mode, inversion=2))
     return sorted([chord, chord6, chordq6],
-                  key=lambda x: Interval(prev_base_tone, get_lowest_note_of_chord(x)).semitones)[0]
+                  key=lambda x: abs(Interval(prev_base_tone, get_lowest_note_of_chord(x)).semitones))[0]
 
 
-def get_lowest_note_of_chord(c: Chord) -> Note:
+def get_lowest_note_of_chord(c: Union[Chord, Tuple[int, ...]]) -> Union[Note, int]:
+    if not isinstance(c, Chord):
+        return int(min(c))
     return sorted(c.notes, key=lambda x: x.pitch)[0]
 
 
@@ -97,19 +131,150 @@ def modify_rhythm(melody: Stream) -> Stream:
         return do_random_split(melody)
 
 
-def create_rhythm() -> Part:
-    part = Part()
-    s = Stream([Note('G4', quarterLength=1),
-                Note('G4', quarterLength=1),
-                Note('G4', quarterLength=1),
-                Note('G4', quarterLength=1)])
-    s.append(s.transpose(0))
+class _IndexedSet:
+    """A set of ints with O(1) add, discard and random choice."""
+    __slots__ = ('items', 'positions')
+
+    def __init__(self):
+        self.items: List[int] = []
+        self.positions: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add(self, item: int):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item: int):
+        pos = self.positions.pop(item, None)
+        if pos is not None:
+            last = self.items.pop()
+            if pos < len(self.items):
+                self.items[pos] = last
+                self.positions[last] = pos
+
+    def choice(self, rng) -> int:
+        return self.items[int(rng.random() * len(self.items))]
+
+
+class RhythmEngine:
+    """
+    Applies the random merges and splits of modify_rhythm to a flat list of
+    durations (in quarter lengths) in place. The notes are a linked list of
+    node ids, so merges and splits only touch their neighbours and the sets
+    of possible merges and splits are updated incrementally.
+
+    Parameters:
+    - durations: quarter lengths of the initial notes.
+    - rng: random.Random or the random module (default).
+    """
+    def __init__(self, durations: Sequence[float], rng=None):
+        self.rng = rng if rng is not None else random
+        n = len(durations)
+        self.durations: List[float] = [float(d) for d in durations]
+        self.next: List[int] = list(range(1, n)) + [-1]
+        self.prev: List[int] = [-1] + list(range(n - 1))
+        self.head = 0 if n > 0 else -1
+        self.free: List[int] = []
+        self.merges = _IndexedSet()  # nodes with the same duration as their successor
+        self.splits = _IndexedSet()  # nodes of at least an eighth
+        for node in range(n):
+            self._update(node)
+
+    def _update(self, node: int):
+        if node < 0:
+            return
+        nxt = self.next[node]
+        if nxt >= 0 and self.durations[node] == self.durations[nxt]:
+            self.merges.add(node)
+        else:
+            self.merges.discard(node)
+        if self.durations[node] >= 0.5:
+            self.splits.add(node)
+        else:
+            self.splits.discard(node)
+
+    def merge(self, node: int):
+        """Merges node with its successor into a note of twice the length."""
+        removed = self.next[node]
+        self.durations[node] *= 2
+        self.next[node] = self.next[removed]
+        if self.next[removed] >= 0:
+            self.prev[self.next[removed]] = node
+        self.merges.discard(removed)
+        self.splits.discard(removed)
+        self.free.append(removed)
+        self._update(self.prev[node])
+        self._update(node)
+
+    def split(self, node: int):
+        """Splits node into two notes of half the length."""
+        self.durations[node] *= 0.5
+        if self.free:
+            added = self.free.pop()
+            self.durations[added] = self.durations[node]
+            self.next[added], self.prev[added] = self.next[node], node
+        else:
+            added = len(self.durations)
+            self.durations.append(self.durations[node])
+            self.next.append(self.next[node])
+            self.prev.append(node)
+        if self.next[node] >= 0:
+            self.prev[self.next[node]] = added
+        self.next[node] = added
+        self._update(self.prev[node])
+        self._update(node)
+        self._update(added)
+
+    def modify(self):
+        """Does a random merge or split like modify_rhythm."""
+        if len(self.merges) >= 1 and len(self.splits) >= 1:
+            if self.rng.random() < 0.5:
+                self.merge(self.merges.choice(self.rng))
+            else:
+                self.split(self.splits.choice(self.rng))
+        elif len(self.merges) >= 1:
+            self.merge(self.merges.choice(self.rng))
+        else:
+            self.split(self.splits.choice(self.rng))
+
+    def to_durations(self) -> NDArray[np.float64]:
+        durations = []
+        node = self.head
+        while node >= 0:
+            durations.append(self.durations[node])
+            node = self.next[node]
+        return np.array(durations, dtype=np.float64)
+
+    def to_stream(self, pitch: str = 'G4') -> Stream:
+        return Stream([Note(pitch, quarterLength=d) for d in self.to_durations()])
+
+
+def create_rhythm_durations(rng=None) -> Tuple[NDArray[np.float64], NDArray[np.float64]]:
+    """
+    The durations of the two streams of create_rhythm: two bars of quarters
+    modified 16 times and the same rhythm modified 2 more times.
+    """
+    engine = RhythmEngine([1.0] * 8, rng)
     for _ in range(16):
-        s = modify_rhythm(s)
-    part.append(s)
+        engine.modify()
+    first = engine.to_durations()
     for _ in range(2):
-        s = modify_rhythm(s)
-    part.append(s)
+        engine.modify()
+    return first, engine.to_durations()
+
+
+def create_rhythms(count: int, seed: Optional[int] = None) -> List[Tuple[NDArray[np.float64], NDArray[np.float64]]]:
+    rng = random.Random(seed)
+    return [create_rhythm_durations(rng) for _ in range(count)]
+
+
+def create_rhythm(rng=None) -> Part:
+    part = Part()
+    for durations in create_rhythm_durations(rng):
+        part.append(Stream([Note('G4', quarterLength=d) for d in durations]))
     return part
 
 
@@ -117,33 +282,34 @@ class RandomComposer:
     def __init__(self):
         self.cf = CircleOfFifths()
 
-    def create_random_chord_stream(self, note_pattern):
+    def create_random_chord_score(self, durations: Sequence[float], rng=None) -> NoteArray:
+        """rng: random.Random or the random module (default)."""
+        rng = rng if rng is not None else random
         directions = [(major, -1), (minor, -1),
                       (major, 0), (minor, 0),
                       (major, 1), (minor, 1)]
-        mode = choice((major, minor))
-        chord_number = randint(0, 11)
-        base_note = self.cf.base_note(chord_number)
-        base_note.quarterLength = note_pattern[0].quarterLength
-        new_chord = build_chord(base_note, mode)
-        s = Stream()
-        s.append(new_chord)
-        for i, pattern_note in enumerate(note_pattern):
+        mode = rng.choice((major, minor))
+        chord_number = rng.randint(0, 11)
+        chords = [build_chord(base_pitch(chord_number), mode)]
+        for _ in durations:
             changing_directions = directions.copy()
             changing_directions.pop(directions.index((mode, 0)))
-            direction = choice(changing_directions)
+            direction = rng.choice(changing_directions)
             chord_number += direction[1]
-            base_note = self.cf.base_note(chord_number % 12)
-            base_note.quarterLength = pattern_note.quarterLength
-            base_note = transpose_to_octave(base_note, 4)
-            new_chord = build_chord(base_note, direction[0])
-            s.append(new_chord)
+            chords.append(build_chord(base_pitch(chord_number % 12), direction[0]))
             mode = direction[0]
-        return s
+        return NoteArray.from_chords(chords, [durations[0]] + list(durations))
+
+    def create_random_chord_stream(self, note_pattern):
+        return self.create_random_chord_score([n.quarterLength for n in note_pattern]).to_stream()
 
-    def compose(self):
-        rhythm = create_rhythm()
-        s = self.create_random_chord_stream(note_pattern=rhythm.notes)
+    def compose(self, rng=None):
+        with span("rhythm"):
+            rhythm = create_rhythm_durations(rng)
+        with span("chords"):
+            score = self.create_random_chord_score(np.concatenate(rhythm), rng)
+        with span("to_stream"):
+            return score.to_stream()
 
 
 
@@ -0,0 +1,315 @@
+import time
+import wave
+import threading
+import numpy as np
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, Sequence
+from numpy.typing import NDArray
+
+if TYPE_CHECKING:
+    # The engine, sources and sinks work without libfluidsynth, only SynthSource plays a synth
+    import fluidsynth
+
+Block = NDArray[np.float32]  # (frames, channels) in the range -1 to 1
+Source = Callable[[int], Optional[Block]]
+Effect = Callable[[Block], Block]
+
+
+def interleaved_to_frames(waveform: NDArray, channels: int = 2) -> Block:
+    """Converts interleaved int16-range samples (like part_to_waveform returns) to a float32 block."""
+    return (waveform.reshape(-1, channels) / np.float32(32768)).astype(np.float32, copy=False)
+
+
+class RingBuffer:
+    """
+    A ring buffer of float32 frames for exactly one producer and one consumer
+    thread. Only the producer moves write_pos and only the consumer moves
+    read_pos, so neither side needs a lock.
+    """
+    def __init__(self, frames: int, channels: int = 2):
+        self.buffer = np.zeros((frames, channels), dtype=np.float32)
+        self.capacity = frames
+        self.write_pos = 0  # Total frames written
+        self.read_pos = 0  # Total frames read
+
+    @property
+    def readable(self) -> int:
+        return self.write_pos - self.read_pos
+
+    @property
+    def writable(self) -> int:
+        return self.capacity - self.readable
+
+    def write(self, data: Block) -> int:
+        n = min(len(data), self.writable)
+        start = self.write_pos % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[:n - first] = data[first:n]
+        self.write_pos += n
+        return n
+
+    def read_into(self, out: Block) -> int:
+        n = min(len(out), self.readable)
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:n] = self.buffer[:n - first]
+        self.read_pos += n
+        return n
+
+
+class SynthSource:
+    """Pulls blocks from a running synth, for example to audition note events live."""
+    def __init__(self, synth: "fluidsynth.Synth"):
+        self.synth = synth
+
+    def __call__(self, frames: int) -> Optional[Block]:
+        return interleaved_to_frames(self.synth.get_samples(frames))
+
+
+class ArraySource:
+    """Plays a (frames, channels) array and ends with it."""
+    def __init__(self, audio: Block):
+        self.audio = audio
+        self.pos = 0
+
+    def __call__(self, frames: int) -> Optional[Block]:
+        if self.pos >= len(self.audio):
+            return None
+        block = self.audio[self.pos:self.pos + frames]
+        self.pos += frames
+        return block
+
+
+class IteratorSource:
+    """Cuts the (frames, channels) chunks of an iterator into blocks of the requested size."""
+    def __init__(self, chunks: Iterable[Block]):
+        self.chunks: Iterator[Block] = iter(chunks)
+        self.pending: Optional[Block] = None
+
+    def __call__(self, frames: int) -> Optional[Block]:
+        parts = []
+        missing = frames
+        while missing > 0:
+            if self.pending is None or len(self.pending) == 0:
+                self.pending = next(self.chunks, None)
+                if self.pending is None:
+                    break
+            parts.append(self.pending[:missing])
+            self.pending = self.pending[missing:]
+            missing -= len(parts[-1])
+        return np.concatenate(parts) if len(parts) > 0 else None
+
+
+class PyAudioSink:
+    """Plays through a pyaudio callback stream."""
+    realtime = True
+
+    def __init__(self, device_index: Optional[int] = None):
+        self.device_index = device_index
+        self.pa = None
+        self.stream = None
+        self.underflows = 0  # Reported by PortAudio
+
+    def start(self, callback: Callable[[Block], bool], sample_rate: int, channels: int, block_size: int):
+        import pyaudio
+        self.pa = pyaudio.PyAudio()
+        out = np.zeros((block_size, channels), dtype=np.float32)
+
+        def stream_callback(in_data, frame_count, time_info, status):
+            nonlocal out
+            if status & pyaudio.paOutputUnderflow:
+                self.underflows += 1
+            if len(out) != frame_count:
+                out = np.zeros((frame_count, channels), dtype=np.float32)
+            keep_running = callback(out)
+            return out.tobytes(), pyaudio.paContinue if keep_running else pyaudio.paComplete
+
+        self.stream = self.pa.open(format=pyaudio.paFloat32, channels=channels, rate=sample_rate, output=True,
+                                   output_device_index=self.device_index, frames_per_buffer=block_size,
+                                   stream_callback=stream_callback)
+        self.stream.start_stream()
+
+    @property
+    def active(self) -> bool:
+        return self.stream is not None and self.stream.is_active()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.pa is not None:
+            self.pa.terminate()
+            self.pa = None
+
+
+class NullSink:
+    """
+    Stands in for the audio device: a thread calls the callback block by
+    block, paced like a device if realtime is set, and throws the audio away.
+    Without realtime the sink waits for the producer instead of running empty.
+    """
+    def __init__(self, realtime: bool = True):
+        self.realtime = realtime
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+
+    def consume(self, block: Block):
+        pass
+
+    def start(self, callback: Callable[[Block], bool], sample_rate: int, channels: int, block_size: int):
+        out = np.zeros((block_size, channels), dtype=np.float32)
+        block_duration = block_size / sample_rate
+
+        def run():
+            next_time = time.perf_counter()
+            while self.running:
+                keep_running = callback(out)
+                self.consume(out)
+                if not keep_running:
+                    break
+                if self.realtime:
+                    next_time += block_duration
+                    time.sleep(max(next_time - time.perf_counter(), 0))
+            self.running = False
+
+        self.running = True
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    @property
+    def active(self) -> bool:
+        return self.running
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.close()
+
+    def close(self):
+        pass
+
+
+class FileSink(NullSink):
+    """Like NullSink but writes the audio to a 16 bit WAV file."""
+    def __init__(self, filename: str, realtime: bool = False):
+        super().__init__(realtime)
+        self.filename = filename
+        self.wav: Optional[wave.Wave_write] = None
+
+    def start(self, callback: Callable[[Block], bool], sample_rate: int, channels: int, block_size: int):
+        self.wav = wave.open(self.filename, "wb")
+        self.wav.setnchannels(channels)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(sample_rate)
+        super().start(callback, sample_rate, channels, block_size)
+
+    def consume(self, block: Block):
+        self.wav.writeframes((np.clip(block, -1, 1) * 32767).astype('<i2').tobytes())
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+
+
+class RealtimeEngine:
+    """
+    Plays audio from a source with low latency. A producer thread pulls
+    blocks from the source, runs them through the effects and writes them
+    into a RingBuffer. The sink's callback reads from the ring buffer and
+    counts an xrun whenever it runs empty before the source has ended.
+
+    The latency is about block_size * buffer_blocks / sample_rate,
+    5.8 ms per block with the defaults.
+
+    Usage:
+        engine = RealtimeEngine(SynthSource(synth), PyAudioSink())
+        engine.start()
+        synth.noteon(0, 60, 100)
+    """
+    def __init__(self, source: Source, sink=None, sample_rate: int = 44100, channels: int = 2,
+                 block_size: int = 256, buffer_blocks: int = 3, effects: Sequence[Effect] = ()):
+        self.source = source
+        self.sink = sink if sink is not None else PyAudioSink()
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.block_size = block_size
+        self.effects = list(effects)
+        self.ring = RingBuffer(block_size * buffer_blocks, channels)
+        self.xruns = 0
+        self.frames_played = 0
+        self.source_finished = False
+        self.running = False
+        self.producer: Optional[threading.Thread] = None
+
+    @property
+    def latency(self) -> float:
+        return self.ring.capacity / self.sample_rate
+
+    def _produce(self):
+        wait = self.block_size / self.sample_rate / 4
+        while self.running:
+            if self.ring.writable < self.block_size:
+                time.sleep(wait)
+                continue
+            block = self.source(self.block_size)
+            if block is None:
+                break
+            for effect in self.effects:
+                block = effect(block)
+            self.ring.write(block)
+        self.source_finished = True
+
+    def _callback(self, out: Block) -> bool:
+        if not self.sink.realtime:
+            while self.ring.readable < len(out) and not self.source_finished:
+                time.sleep(0.0005)
+        n = self.ring.read_into(out)
+        self.frames_played += n
+        if n < len(out):
+            out[n:] = 0
+            if not self.source_finished:
+                self.xruns += 1
+        return not (self.source_finished and self.ring.readable == 0)
+
+    def start(self, prefill: bool = True):
+        self.running = True
+        self.producer = threading.Thread(target=self._produce, daemon=True)
+        self.producer.start()
+        if prefill:
+            while self.ring.writable >= self.block_size and not self.source_finished:
+                time.sleep(0.001)
+        self.sink.start(self._callback, self.sample_rate, self.channels, self.block_size)
+
+    def wait(self):
+        """Blocks until the source has ended and everything is played."""
+        while self.sink.active:
+            time.sleep(0.01)
+        self.stop()
+
+    def stop(self):
+        self.running = False
+        if self.producer is not None:
+            self.producer.join()
+        self.sink.stop()
+
+
+if __name__ == "__main__":
+    import fluidsynth
+
+    fs = fluidsynth.Synth(gain=0.98, samplerate=44100)
+    sfid = fs.sfload("soundfonts/organ/Aggorg.sf2")
+    fs.program_select(0, sfid, 0, 0)
+    engine = RealtimeEngine(SynthSource(fs), PyAudioSink(), block_size=128, buffer_blocks=4)
+    print(f"Latency: {engine.latency * 1000:.1f} ms")
+    engine.start()
+    for pitch in (60, 64, 67, 72):
+        fs.noteon(0, pitch, 100)
+        time.sleep(0.3)
+        fs.noteoff(0, pitch)
+    engine.stop()
+    print(f"{engine.xruns} xruns")
+    fs.delete()
@@ -0,0 +1,115 @@
+import os
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Optional
+from numpy.typing import NDArray
+from instrumentation import count
+
+
+def soundfont_identity(soundfont_filename: str) -> str:
+    """Path, size and modification time, so a changed SoundFont gets new keys."""
+    stat = os.stat(soundfont_filename)
+    return f"{os.path.abspath(soundfont_filename)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def render_key(midi_bytes: bytes, soundfont_filename: str, sample_rate: int, gain: float) -> str:
+    h = hashlib.sha256(midi_bytes)
+    h.update(f"|{soundfont_identity(soundfont_filename)}|{sample_rate}|{gain!r}".encode("utf-8"))
+    return h.hexdigest()
+
+
+class RenderCache:
+    """
+    Caches rendered waveforms by render_key. The memory tier is an LRU of
+    arrays, the optional disk tier an LRU of .npy files in directory which
+    are memory-mapped on a hit. Both tiers evict the least recently used
+    entries when they exceed their byte budget.
+
+    The returned arrays are shared with the cache (and read-only when they
+    come from disk), so copy them before modifying them.
+    """
+    def __init__(self, directory: Optional[str] = None,
+                 memory_bytes: int = 256 * 1024 ** 2, disk_bytes: int = 4 * 1024 ** 3):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory: OrderedDict[str, NDArray[np.float32]] = OrderedDict()  # least recently used first
+        self.memory_used = 0
+        self.disk: OrderedDict[str, int] = OrderedDict()
+        self.disk_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            entries = [e for e in os.scandir(directory) if e.name.endswith(".npy")]
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime_ns):
+                self.disk[entry.name[:-4]] = entry.stat().st_size
+                self.disk_used += entry.stat().st_size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key: str) -> Optional[NDArray[np.float32]]:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                count("cache_hits")
+                return self.memory[key]
+            if key in self.disk:
+                try:
+                    waveform = np.load(self._path(key), mmap_mode="r")
+                except FileNotFoundError:
+                    self.disk_used -= self.disk.pop(key)
+                else:
+                    os.utime(self._path(key))
+                    self.disk.move_to_end(key)
+                    self._put_in_memory(key, waveform)
+                    self.hits += 1
+                    count("cache_hits")
+                    return waveform
+            self.misses += 1
+            count("cache_misses")
+            return None
+
+    def put(self, key: str, waveform: NDArray[np.float32]):
+        with self.lock:
+            self._put_in_memory(key, waveform)
+            if self.directory is not None and key not in self.disk and waveform.nbytes <= self.disk_bytes:
+                temp_path = self._path(key) + f".{os.getpid()}.tmp"
+                with open(temp_path, "wb") as f:
+                    np.save(f, waveform)
+                count("bytes_written", waveform.nbytes)
+                os.replace(temp_path, self._path(key))
+                size = os.path.getsize(self._path(key))
+                self.disk[key] = size
+                self.disk_used += size
+                while self.disk_used > self.disk_bytes:
+                    old_key, old_size = self.disk.popitem(last=False)
+                    self.disk_used -= old_size
+                    try:
+                        os.remove(self._path(old_key))
+                    except FileNotFoundError:
+                        pass
+
+    def _put_in_memory(self, key: str, waveform: NDArray[np.float32]):
+        if waveform.nbytes > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = waveform
+        self.memory_used += waveform.nbytes
+        while self.memory_used > self.memory_bytes:
+            _, old_waveform = self.memory.popitem(last=False)
+            self.memory_used -= old_waveform.nbytes
+
+    def get_or_render(self, key: str, render: Callable[[], NDArray[np.float32]]) -> NDArray[np.float32]:
+        waveform = self.get(key)
+        if waveform is None:
+            waveform = render()
+            self.put(key, waveform)
+        return waveform
@@ -0,0 +1,217 @@
+import os
+import json
+import random
+import numpy as np
+from typing import Dict, List, Optional
+from numpy.typing import NDArray
+from music21.chord import Chord
+from music21.note import Note
+from music21.stream import Stream, Part
+from midi2wave import part_to_waveform
+from random_composer import RandomComposer
+from synth_pool import SynthPool
+
+INDEX_DTYPE = np.dtype([('shard', np.int32), ('offset', np.int64), ('frames', np.int64), ('signals', np.int16)])
+
+
+def find_soundfonts(directory: str = "soundfonts") -> Dict[str, str]:
+    """
+    Maps every instrument directory in directory to the first .sf2 file in it.
+    """
+    soundfonts = {}
+    for instrument_type in sorted(os.listdir(directory)):
+        instrument_dir = os.path.join(directory, instrument_type)
+        if not os.path.isdir(instrument_dir):
+            continue
+        sf2_files = sorted(f for f in os.listdir(instrument_dir) if f.lower().endswith(".sf2"))
+        if len(sf2_files) > 0:
+            soundfonts[instrument_type] = os.path.join(instrument_dir, sf2_files[0])
+    return soundfonts
+
+
+def split_voices(chord_stream: Stream) -> List[Part]:
+    """
+    Splits a stream of chords into one Part per voice, lowest voice first.
+    """
+    voices: List[Part] = []
+    for chord in chord_stream.getElementsByClass(Chord):
+        pitches = sorted(chord.pitches)
+        while len(voices) < len(pitches):
+            voices.append(Part())
+        for voice, pitch in zip(voices, pitches):
+            voice.append(Note(pitch, quarterLength=chord.quarterLength))
+    return voices
+
+
+class StemDatasetWriter:
+    """
+    Writes examples of a mix and its stems into fixed-size shards of
+    contiguous float32. Every example is stored as an array of shape
+    (signals, frames, 2) where signal 0 is the mix. The index (index.npy)
+    holds shard, offset, frames and signals of every example, the metadata
+    goes to metadata.jsonl with one line per example.
+
+    shard_size counts float32 values, the default of 64Mi values makes
+    shards of 256 MB. Every shard gets cut to the values it holds when the
+    writer moves on to the next one or is closed.
+    """
+    def __init__(self, directory: str, shard_size: int = 64 * 1024 ** 2):
+        self.directory = directory
+        self.shard_size = shard_size
+        os.makedirs(directory, exist_ok=True)
+        self.index: List[tuple] = []
+        self.shard_no = -1
+        self.shard: Optional[np.memmap] = None
+        self.shard_pos = 0
+        self.metadata_file = open(os.path.join(directory, "metadata.jsonl"), "w")
+
+    def _finish_shard(self):
+        """Flushes the shard and truncates the .npy file after its last example."""
+        self.shard.flush()
+        filename = self.shard.filename
+        self.shard = None
+        with open(filename, "r+b") as f:
+            np.lib.format.read_magic(f)
+            np.lib.format.read_array_header_1_0(f)
+            data_offset = f.tell()
+            f.seek(0)
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                                                     'fortran_order': False, 'shape': (self.shard_pos,)})
+            # The header is padded to 64 bytes, a shorter shape does not move the data
+            assert f.tell() == data_offset
+            f.truncate(data_offset + self.shard_pos * np.dtype(np.float32).itemsize)
+
+    def _next_shard(self):
+        if self.shard is not None:
+            self._finish_shard()
+        self.shard_no += 1
+        self.shard = np.lib.format.open_memmap(os.path.join(self.directory, f"shard-{self.shard_no:05d}.npy"),
+                                               mode="w+", dtype=np.float32, shape=(self.shard_size,))
+        self.shard_pos = 0
+
+    def reserve(self, signals: int, frames: int, metadata: Optional[dict] = None) -> NDArray[np.float32]:
+        """
+        Adds an example and returns its (signals, frames, 2) slice of the
+        shard to be filled in place.
+        """
+        size = signals * frames * 2
+        if size > self.shard_size:
+            raise ValueError(f"An example with {size} values does not fit into shards of {self.shard_size} values.")
+        if self.shard is None or self.shard_pos + size > self.shard_size:
+            self._next_shard()
+        offset = self.shard_pos
+        self.shard_pos += size
+        self.index.append((self.shard_no, offset, frames, signals))
+        self.metadata_file.write(json.dumps(metadata or {}) + "\n")
+        return self.shard[offset:offset + size].reshape(signals, frames, 2)
+
+    def add(self, mix: NDArray[np.float32], stems: List[NDArray[np.float32]], metadata: Optional[dict] = None):
+        example = self.reserve(len(stems) + 1, mix.shape[0], metadata)
+        example[0] = mix
+        for i, stem in enumerate(stems):
+            example[i + 1] = stem
+
+    def close(self):
+        if self.shard is not None:
+            self._finish_shard()
+        np.save(os.path.join(self.directory, "index.npy"), np.array(self.index, dtype=INDEX_DTYPE))
+        self.metadata_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class StemDataset:
+    """
+    Reads a dataset written by StemDatasetWriter. Examples and windows are
+    views into memory-mapped shards, nothing is copied or decoded.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index = np.load(os.path.join(directory, "index.npy"))
+        self.shards: Dict[int, np.memmap] = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _shard(self, shard_no: int) -> np.memmap:
+        if shard_no not in self.shards:
+            self.shards[shard_no] = np.load(os.path.join(self.directory, f"shard-{shard_no:05d}.npy"), mmap_mode="r")
+        return self.shards[shard_no]
+
+    def example(self, i: int) -> NDArray[np.float32]:
+        shard_no, offset, frames, signals = self.index[i]
+        return self._shard(int(shard_no))[offset:offset + signals * frames * 2].reshape(signals, frames, 2)
+
+    def window(self, i: int, start: int, frames: int) -> NDArray[np.float32]:
+        return self.example(i)[:, start:start + frames]
+
+    def random_window(self, frames: int, rng: np.random.Generator) -> NDArray[np.float32]:
+        i = rng.integers(len(self))
+        start = rng.integers(max(int(self.index[i]['frames']) - frames, 0) + 1)
+        return self.window(i, start, frames)
+
+    def metadata(self) -> List[dict]:
+        with open(os.path.join(self.directory, "metadata.jsonl")) as f:
+            return [json.loads(line) for line in f]
+
+
+def render_stems(voices: List[Part], instruments: List[str], soundfonts: Dict[str, str], pool: SynthPool,
+                 sample_rate: int = 44100) -> List[NDArray[np.float32]]:
+    stems = []
+    for voice, instrument in zip(voices, instruments):
+        with pool.synth(soundfonts[instrument]) as (synth, sfid):
+            stems.append(part_to_waveform(voice, synth, soundfonts[instrument], sample_rate, sfid=sfid))
+    return stems
+
+
+def example_frames(stems: List[NDArray[np.float32]]) -> int:
+    return max(len(stem) for stem in stems) // 2
+
+
+def mix_stems_into(stems: List[NDArray[np.float32]], out: NDArray[np.float32]) -> NDArray[np.float32]:
+    """
+    Writes the mix and the stems (as rendered by part_to_waveform) scaled to
+    [-1, 1] into out, which has the shape (len(stems) + 1, frames, 2).
+    """
+    out[0] = 0
+    for i, stem in enumerate(stems):
+        stem_frames = len(stem) // 2
+        np.multiply(stem.reshape(-1, 2), 1 / 32768, out=out[i + 1, :stem_frames])
+        out[i + 1, stem_frames:] = 0
+        out[0] += out[i + 1]
+    return out
+
+
+def build_stem_dataset(directory: str, examples: int, soundfonts: Optional[Dict[str, str]] = None,
+                       shard_size: int = 64 * 1024 ** 2, sample_rate: int = 44100, seed: Optional[int] = None,
+                       pool: Optional[SynthPool] = None):
+    """
+    Composes examples with the RandomComposer, renders every voice with its
+    own instrument as a stem and writes stems and mix with a StemDatasetWriter.
+    A pool passed in keeps its synths after the build, e.g. for the next build.
+    """
+    if soundfonts is None:
+        soundfonts = find_soundfonts()
+    rng = random.Random(seed)
+    composer = RandomComposer()
+    own_pool = pool is None
+    if own_pool:
+        pool = SynthPool()
+    with StemDatasetWriter(directory, shard_size) as writer:
+        for _ in range(examples):
+            voices = split_voices(composer.compose(rng))
+            instruments = [rng.choice(list(soundfonts)) for _ in voices]
+            stems = render_stems(voices, instruments, soundfonts, pool, sample_rate)
+            mix_stems_into(stems, writer.reserve(len(stems) + 1, example_frames(stems), {"instruments": instruments}))
+    if own_pool:
+        pool.close()
+
+
+if __name__ == "__main__":
+    build_stem_dataset("dataset", 4, seed=0)
+    ds = StemDataset("dataset")
+    print(f"{len(ds)} examples, first window: {ds.window(0, 0, 44100).shape}")
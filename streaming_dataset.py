@@ -0,0 +1,120 @@
+import random
+import threading
+import numpy as np
+import torch
+from queue import Queue, Empty, Full
+from typing import Dict, Iterator, Optional, Tuple
+from numpy.typing import NDArray
+from torch.utils.data import IterableDataset, get_worker_info
+from music21.tempo import MetronomeMark
+from emotional_narrative import EmotionSequenceGenerator
+from random_composer import RandomComposer
+from stem_dataset import find_soundfonts, split_voices, render_stems, example_frames, mix_stems_into
+from synth_pool import SynthPool
+from mixing import augment
+
+
+class StreamingStemDataset(IterableDataset):
+    """
+    Composes and renders training examples on the fly. Every DataLoader
+    worker draws emotion sequences, composes with the RandomComposer and
+    renders the voices as stems with its own SynthPool. A producer thread
+    keeps up to prefetch rendered examples in a queue. Every example is cut
+    into windows_per_example random windows of window_frames frames.
+
+    Yields (mix, stems) tensors with the shapes (2, window_frames) and
+    (stems, 2, window_frames). The random state of every worker is seeded
+    with seed + worker id. With augment the stems of every window get random
+    gains, panning and time shifts and the mix is built from them.
+    """
+    def __init__(self, soundfonts: Optional[Dict[str, str]] = None, window_frames: int = 4 * 44100,
+                 windows_per_example: int = 4, seq_len: int = 8, prefetch: int = 4, seed: int = 0,
+                 sample_rate: int = 44100, augment: bool = False):
+        super().__init__()
+        self.soundfonts = soundfonts if soundfonts is not None else find_soundfonts()
+        self.window_frames = window_frames
+        self.windows_per_example = windows_per_example
+        self.seq_len = seq_len
+        self.prefetch = prefetch
+        self.seed = seed
+        self.sample_rate = sample_rate
+        self.augment = augment
+
+    @staticmethod
+    def _put(examples: Queue, item, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                examples.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _produce(self, examples: Queue, stop: threading.Event, seed: int):
+        # Own random states, so the global ones of the training process stay untouched
+        rng = random.Random(seed)
+        generator = torch.Generator().manual_seed(seed)
+        esg = EmotionSequenceGenerator()
+        composer = RandomComposer()
+        pool = SynthPool()
+        try:
+            while not stop.is_set():
+                emotions = esg.generate_sequence(self.seq_len, generator=generator)
+                # More motivation, faster music
+                tempo = 90 + 50 * float(emotions[:, 1].mean())
+                voices = split_voices(composer.compose(rng))
+                for voice in voices:
+                    voice.insert(0, MetronomeMark(number=tempo))
+                instruments = [rng.choice(list(self.soundfonts)) for _ in voices]
+                stems = render_stems(voices, instruments, self.soundfonts, pool, self.sample_rate)
+                example = mix_stems_into(stems, np.empty((len(stems) + 1, example_frames(stems), 2),
+                                                         dtype=np.float32))
+                self._put(examples, example, stop)
+        except Exception as e:
+            # Hand the error to the consuming side of the worker
+            self._put(examples, e, stop)
+        finally:
+            pool.close()
+
+    def _windows(self, example: NDArray[np.float32],
+                 rng: np.random.Generator) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        frames = example.shape[1]
+        windows = np.zeros((self.windows_per_example, example.shape[0], 2, self.window_frames), dtype=np.float32)
+        for window in windows:
+            start = rng.integers(max(frames - self.window_frames, 0) + 1)
+            part = example[:, start:start + self.window_frames].transpose(0, 2, 1)
+            window[:, :, :part.shape[2]] = part
+        if self.augment:
+            augment(windows[:, 1:], rng, windows[:, 0], max_shift=self.sample_rate // 10)
+        for window in torch.from_numpy(windows):
+            yield window[0], window[1:]
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        worker_info = get_worker_info()
+        worker_seed = self.seed + (worker_info.id if worker_info is not None else 0)
+        rng = np.random.default_rng(worker_seed)
+        examples = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(examples, stop, worker_seed), daemon=True)
+        producer.start()
+        try:
+            while True:
+                try:
+                    example = examples.get(timeout=1.0)
+                except Empty:
+                    if not producer.is_alive():
+                        break
+                    continue
+                if isinstance(example, Exception):
+                    raise example
+                yield from self._windows(example, rng)
+        finally:
+            stop.set()
+            producer.join()
+
+
+if __name__ == "__main__":
+    from torch.utils.data import DataLoader
+    loader = DataLoader(StreamingStemDataset(window_frames=44100), batch_size=4, num_workers=2)
+    for mix, stems in loader:
+        print(mix.shape, stems.shape)
+        break
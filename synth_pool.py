@@ -0,0 +1,115 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, Iterator, NamedTuple, Tuple
+import fluidsynth
+from midi2wave import create_fluidsynth
+
+
+class LoadedFont(NamedTuple):
+    filename: str
+    sfid: int
+    footprint: int
+
+
+def reset_synth(synth: fluidsynth.Synth, sfid: int, midi_channels: int = 1):
+    """
+    Silences the synth and resets controllers and programs of all channels
+    so the next job starts from the same state as a freshly loaded synth.
+    """
+    for chan in range(midi_channels):
+        synth.all_sounds_off(chan)
+        synth.cc(chan, 121, 0)  # Reset all controllers
+        synth.program_select(chan, sfid, 0, 0)
+
+
+class SynthPool:
+    """
+    Keeps fluidsynth.Synth instances with their SoundFonts loaded, so renders
+    with the same SoundFont skip sfload. Every synth holds one SoundFont. When
+    the loaded SoundFonts exceed max_bytes the least recently used idle synths
+    are deleted. The default synths render offline, without an audio driver.
+
+    Usage:
+        pool = SynthPool()
+        with pool.synth("soundfonts/organ/Aggorg.sf2") as (synth, sfid):
+            waveform = part_to_waveform(melody, synth, "soundfonts/organ/Aggorg.sf2", sfid=sfid)
+    """
+    def __init__(self, max_bytes: int = 2 * 1024 ** 3,
+                 synth_factory: Callable[[], fluidsynth.Synth] = partial(create_fluidsynth, start=False),
+                 midi_channels: int = 1):
+        self.max_bytes = max_bytes
+        self.synth_factory = synth_factory
+        self.midi_channels = midi_channels
+        self.idle: OrderedDict[fluidsynth.Synth, LoadedFont] = OrderedDict()  # least recently used first
+        self.busy: Dict[fluidsynth.Synth, LoadedFont] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def loaded_bytes(self) -> int:
+        return sum(font.footprint for font in self.idle.values()) + \
+            sum(font.footprint for font in self.busy.values())
+
+    def checkout(self, soundfont_filename: str) -> Tuple[fluidsynth.Synth, int]:
+        filename = os.path.abspath(soundfont_filename)
+        with self.lock:
+            for synth in reversed(self.idle):
+                font = self.idle[synth]
+                if font.filename == filename:
+                    del self.idle[synth]
+                    self.busy[synth] = font
+                    return synth, font.sfid
+            footprint = os.path.getsize(filename)
+            self._evict(footprint)
+        synth = self.synth_factory()
+        sfid = synth.sfload(filename)
+        if sfid < 0:
+            synth.delete()
+            raise ValueError(f"Could not load the SoundFont {soundfont_filename}.")
+        synth.program_select(0, sfid, 0, 0)
+        with self.lock:
+            self.busy[synth] = LoadedFont(filename, sfid, footprint)
+        return synth, sfid
+
+    def checkin(self, synth: fluidsynth.Synth):
+        with self.lock:
+            font = self.busy.pop(synth)
+            reset_synth(synth, font.sfid, self.midi_channels)
+            self.idle[synth] = font
+            self._evict(0)
+
+    @contextmanager
+    def synth(self, soundfont_filename: str) -> Iterator[Tuple[fluidsynth.Synth, int]]:
+        synth, sfid = self.checkout(soundfont_filename)
+        try:
+            yield synth, sfid
+        finally:
+            self.checkin(synth)
+
+    def _evict(self, additional_bytes: int):
+        loaded_bytes = self.loaded_bytes
+        while loaded_bytes + additional_bytes > self.max_bytes and len(self.idle) > 0:
+            synth, font = self.idle.popitem(last=False)
+            synth.delete()
+            loaded_bytes -= font.footprint
+
+    def close(self):
+        with self.lock:
+            for synth in self.idle:
+                synth.delete()
+            self.idle.clear()
+
+
+if __name__ == "__main__":
+    from music21.note import Note
+    from music21.stream import Stream
+    from midi2wave import part_to_waveform
+    pool = SynthPool()
+    strm = Stream([Note('G4', quarterLength=1), Note('C4', quarterLength=1)])
+    for _ in range(3):
+        with pool.synth("soundfonts/organ/Aggorg.sf2") as (fl, fl_sfid):
+            w = part_to_waveform(strm, fl, "soundfonts/organ/Aggorg.sf2", sfid=fl_sfid)
+        print(f"Rendered {w.shape} with {len(pool.idle)} idle synths holding {pool.loaded_bytes} bytes.")
+    pool.close()